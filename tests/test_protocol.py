@@ -0,0 +1,137 @@
+"""Tests for request head parsing and body framing in wsgi/protocol.py"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'wsgi'))
+
+from protocol import SocketReader, RequestBody, RequestError, parse_head
+
+
+class FakeSocket(object):
+    """Hands out 'data' in recv() calls of at most 'step' bytes"""
+
+    def __init__(self, data, step=7):
+        self.data = data
+        self.step = step
+
+    def recv(self, size):
+        data = self.data[:min(size, self.step)]
+        self.data = self.data[len(data):]
+        return data
+
+
+def reader(data):
+    return SocketReader(FakeSocket(data))
+
+
+class ParseHeadTest(unittest.TestCase):
+
+    def test_headers(self):
+        line, headers = parse_head(
+            'POST /x HTTP/1.1\r\nHost: a\r\nContent-Length: 3\r\n'
+            'X-Foo: 1\r\nX-Foo: 2\r\nX-Long: a\r\n b')
+        self.assertEqual(line, 'POST /x HTTP/1.1')
+        self.assertEqual(headers, {'HTTP_HOST': 'a', 'CONTENT_LENGTH': '3',
+                                   'HTTP_X_FOO': '1,2', 'HTTP_X_LONG': 'a b'})
+
+    def test_underscore_names_dropped(self):
+        line, headers = parse_head(
+            'POST / HTTP/1.1\r\nContent_Length: 10\r\n'
+            'Transfer_Encoding: chunked\r\n continued\r\nX_Forwarded_For: 1')
+        self.assertEqual(headers, {})
+
+    def test_underscore_name_cannot_override(self):
+        line, headers = parse_head(
+            'POST / HTTP/1.1\r\nContent-Length: 3\r\nContent_Length: 10')
+        self.assertEqual(headers, {'CONTENT_LENGTH': '3'})
+
+    def test_bad_lines(self):
+        for head in ('GET / HTTP/1.1\r\nNoColon',
+                     'GET / HTTP/1.1\r\nName : value',
+                     'GET / HTTP/1.1\r\n folded'):
+            self.assertRaises(RequestError, parse_head, head)
+
+    def test_too_many_headers(self):
+        head = 'GET / HTTP/1.1' + '\r\nX-A: 1' * 3
+        try:
+            parse_head(head, max_headers=2)
+        except RequestError as e:
+            self.assertEqual(e.code, 431)
+        else:
+            self.fail('no RequestError')
+
+
+class RequestBodyTest(unittest.TestCase):
+
+    def test_length(self):
+        rfile = reader('helloGET /next')
+        body = RequestBody(rfile, 5)
+        self.assertEqual(body.read(), 'hello')
+        self.assertEqual(body.read(), '')
+        self.assertTrue(body.done)
+        self.assertEqual(rfile.read(), 'GET /next')
+
+    def test_chunked(self):
+        rfile = reader('3\r\nabc\r\n2;ext=1\r\nde\r\n0\r\nX-T: 1\r\n\r\nnext')
+        body = RequestBody(rfile, chunked=True)
+        self.assertEqual(body.read(), 'abcde')
+        self.assertTrue(body.done)
+        self.assertEqual(rfile.read(), 'next')
+
+    def test_chunked_lines(self):
+        body = RequestBody(reader('4\r\na\nb\n\r\n3\r\nc\nd\r\n0\r\n\r\n'),
+                           chunked=True)
+        self.assertEqual(body.readlines(), ['a\n', 'b\n', 'c\n', 'd'])
+
+    def test_bad_chunk(self):
+        for data in ('x\r\n', '3\r\nabcX\r\n', '-1\r\n'):
+            body = RequestBody(reader(data), chunked=True)
+            self.assertRaises(RequestError, body.read)
+            self.assertFalse(body.drain())
+
+    def test_chunked_too_large(self):
+        body = RequestBody(reader('a\r\n0123456789\r\n0\r\n\r\n'),
+                           chunked=True, max_size=5)
+        try:
+            body.read()
+        except RequestError as e:
+            self.assertEqual(e.code, 413)
+        else:
+            self.fail('no RequestError')
+
+    def test_cut_short(self):
+        body = RequestBody(reader('abc'), 10)
+        self.assertEqual(body.read(), 'abc')
+        self.assertTrue(body.failed)
+        self.assertFalse(body.drain())
+
+    def test_drain(self):
+        rfile = reader('0123456789next')
+        body = RequestBody(rfile, 10)
+        self.assertEqual(body.read(4), '0123')
+        self.assertTrue(body.drain())
+        self.assertEqual(rfile.read(), 'next')
+        self.assertFalse(RequestBody(reader('x' * 100), 100).drain(limit=10))
+
+    def test_drainable(self):
+        self.assertTrue(RequestBody(reader(''), 0).drainable())
+        self.assertTrue(RequestBody(reader('x' * 10), 10).drainable(10))
+        self.assertFalse(RequestBody(reader('x' * 11), 11).drainable(10))
+        body = RequestBody(reader('abc'), 3, send_continue=lambda: None)
+        self.assertFalse(body.drainable())
+
+    def test_continue(self):
+        sent = []
+        body = RequestBody(reader('abc'), 3,
+                           send_continue=lambda: sent.append(1))
+        self.assertFalse(body.drain())
+        self.assertEqual(sent, [])
+        self.assertEqual(body.read(), 'abc')
+        self.assertEqual(sent, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Access logging off the request path"""
+
+import os
+import sys
+import time
+import threading
+import Queue
+
+__all__ = ['AccessLog']
+
+
+class AccessLog(object):
+    """Write access log records from a background thread, in batches
+
+    log() and message() only queue a record; a writer thread formats up to
+    'batch_size' queued records at a time and writes them to 'stream' (or
+    the file at 'path') with a single write and flush.  When 'queue_size'
+    records are waiting, new ones are dropped and counted in 'dropped',
+    or with policy='block' the caller waits for room.
+
+    Records are dictionaries formatted with 'format', or 'message_format'
+    for free-form messages; the fields are time, remote_addr, method, path,
+    protocol, status, bytes and duration (seconds) or message.
+    """
+
+    format = ('%(remote_addr)s - - [%(time)s] "%(method)s %(path)s '
+              '%(protocol)s" %(status)s %(bytes)s %(duration).6f\n')
+    message_format = '%(remote_addr)s - - [%(time)s] %(message)s\n'
+    time_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, stream=None, path=None, format=None, queue_size=10000,
+                 batch_size=256, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError("policy must be 'drop' or 'block'")
+        if path is not None:
+            stream = open(path, 'a')
+        self.stream = stream or sys.stderr
+        if format is not None:
+            self.format = format
+        self.batch_size = batch_size
+        self.block = policy == 'block'
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def log(self, **record):
+        """Queue an access log record"""
+        record['time'] = time.time()
+        self.put(record)
+
+    def message(self, remote_addr, message):
+        """Queue a free-form log line"""
+        self.put({'time': time.time(), 'remote_addr': remote_addr,
+                  'message': message})
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        # (Re)start the writer in this process; threads don't survive fork
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.queue.maxsize)
+            self.thread = threading.Thread(target=self.run,
+                                           name='access-log-writer')
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        stamp = formatted = None
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    self.flush(lines)
+                    return
+                second = int(record['time'])
+                if second != stamp:
+                    stamp = second
+                    formatted = time.strftime(self.time_format,
+                                              time.localtime(second))
+                record['time'] = formatted
+                if 'message' in record:
+                    lines.append(self.message_format % record)
+                else:
+                    lines.append(self.format % record)
+            self.flush(lines)
+
+    def flush(self, lines):
+        if not lines:
+            return
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        """Write out what is queued and stop the writer thread"""
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = self.pid = None
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""Load generator for the servers in this directory
+
+Starts make_server() with an application in a subprocess and drives it
+from forked client processes, each running an epoll loop over its share
+of the connections.  Reports requests per second, latency percentiles,
+the server's memory, context switches and read/write system calls,
+optionally all of its system calls with strace, and writes the results
+as JSON so runs of different commits can be compared:
+
+    python bench.py --app simple --server threads -c 50 -d 10 --json out.json
+    python bench.py --app stream --path '/?blocks=64&size=4096' --pipeline 4
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import marshal
+import select
+import signal
+import socket
+import argparse
+import subprocess
+from urlparse import parse_qs
+
+from app import simple_app, AppClass
+from handlers import WSGIRequestHandler, EventRequestHandler
+from server import make_server, WSGIServer, EpollWSGIServer, AsyncWSGIServer
+
+__all__ = ['stream_app', 'run_benchmark']
+
+
+def stream_app(environ, start_response):
+    """Stream 'blocks' blocks of 'size' bytes, as given in the query string
+
+    Nothing tells the server the length up front, so HTTP/1.1 responses
+    go out chunked.
+    """
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    blocks = int(query.get('blocks', ['16'])[0])
+    block = 'x' * int(query.get('size', ['1024'])[0])
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    for i in xrange(blocks):
+        yield block
+
+
+APPS = {
+    'simple': simple_app,
+    'class': AppClass,
+    'stream': stream_app,
+}
+
+# name -> (server class, handler class, make_server arguments)
+SERVERS = {
+    'plain': (WSGIServer, WSGIRequestHandler, {}),
+    'threads': (WSGIServer, WSGIRequestHandler, {'workers': 10}),
+    'prefork': (WSGIServer, WSGIRequestHandler, {'processes': 4}),
+    'epoll': (EpollWSGIServer, EventRequestHandler, {}),
+    'async': (AsyncWSGIServer, EventRequestHandler, {}),
+}
+
+
+def serve(app_name, server_name, port):
+    """Run a server in this process until it is killed"""
+    server_class, handler_class, kwargs = SERVERS[server_name]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    make_server('127.0.0.1', port, APPS[app_name], server_class=server_class,
+                handler_class=handler_class, **kwargs)
+
+
+# --- client -------------------------------------------------------------
+
+class _Conn(object):
+    """A client connection and the responses it is waiting for"""
+
+    __slots__ = ('sock', 'connected', 'out', 'inbuf', 'sent', 'body_start',
+                 'mode', 'end', 'status', 'close')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.connected = False
+        self.out = ''
+        self.inbuf = ''
+        self.sent = []          # send times of the requests in flight
+        self.body_start = None  # set once the response head is in
+
+
+def _parse_head(conn):
+    """Find the next response head in conn.inbuf; False if incomplete"""
+    end = conn.inbuf.find('\r\n\r\n')
+    if end < 0:
+        return False
+    lines = conn.inbuf[:end].split('\r\n')
+    conn.status = int(lines[0][9:12])
+    conn.body_start = end + 4
+    conn.close = False
+    length = None
+    chunked = False
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = value == 'chunked'
+        elif name == 'connection':
+            conn.close = value == 'close'
+    if conn.status in (204, 304) or 100 <= conn.status < 200:
+        length = 0
+    if chunked:
+        conn.mode, conn.end = 'chunked', conn.body_start
+    elif length is not None:
+        conn.mode, conn.end = 'length', conn.body_start + length
+    else:
+        conn.mode, conn.end = 'close', None
+        conn.close = True
+    return True
+
+
+def _response_end(conn):
+    """Return where the current response ends in conn.inbuf, or -1"""
+    buf = conn.inbuf
+    if conn.mode == 'length':
+        return conn.end if len(buf) >= conn.end else -1
+    if conn.mode == 'close':
+        return -1
+    pos = conn.end              # start of the next chunk size line
+    while True:
+        eol = buf.find('\r\n', pos)
+        if eol < 0:
+            return -1
+        size = int(buf[pos:eol].split(';', 1)[0], 16)
+        if size == 0:
+            end = buf.find('\r\n\r\n', eol)     # after any trailers
+            return end + 4 if end >= 0 else -1
+        if len(buf) < eol + 2 + size + 2:
+            conn.end = pos
+            return -1
+        pos = eol + 2 + size + 2
+
+
+def _make_request(opts):
+    lines = ['%s %s HTTP/1.1' % ('POST' if opts.body else 'GET', opts.path),
+             'Host: 127.0.0.1:%d' % opts.port]
+    if not opts.keepalive:
+        lines.append('Connection: close')
+    if opts.body:
+        lines.append('Content-Type: application/octet-stream')
+        lines.append('Content-Length: %d' % opts.body)
+    return '\r\n'.join(lines) + '\r\n\r\n' + 'x' * opts.body
+
+
+def run_client(opts, connections, record_from, deadline):
+    """Drive 'connections' connections until 'deadline'
+
+    Returns a dictionary with the latencies (seconds) of the responses
+    completed after 'record_from', and counts of everything else.
+    """
+    request = _make_request(opts)
+    epoll = select.epoll()
+    conns = {}
+    result = {'latencies': [], 'statuses': {}, 'errors': 0, 'unanswered': 0,
+              'connects': 0, 'bytes': 0}
+
+    def connect():
+        # Non-blocking, so a connection waiting for room in the server's
+        # listen backlog doesn't hold up the others
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        err = sock.connect_ex(('127.0.0.1', opts.port))
+        if err not in (0, errno.EINPROGRESS):
+            result['errors'] += 1
+            sock.close()
+            return
+        conn = _Conn(sock)
+        conns[sock.fileno()] = conn
+        epoll.register(sock.fileno(), select.EPOLLOUT)
+
+    def connected(conn):
+        if conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            drop(conn, True)
+            return
+        conn.connected = True
+        result['connects'] += 1
+        epoll.modify(conn.sock.fileno(), select.EPOLLIN)
+        fill(conn)
+
+    def fill(conn):
+        n = opts.pipeline - len(conn.sent)
+        if n <= 0 or time.time() >= deadline:
+            return
+        if not opts.keepalive:
+            n = min(n, 1 - len(conn.sent))
+        now = time.time()
+        conn.sent.extend([now] * n)
+        conn.out += request * n
+        send(conn)
+
+    def send(conn):
+        try:
+            sent = conn.sock.send(conn.out)
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                drop(conn, True)
+            return
+        conn.out = conn.out[sent:]
+        mask = select.EPOLLIN | (select.EPOLLOUT if conn.out else 0)
+        epoll.modify(conn.sock.fileno(), mask)
+
+    def drop(conn, error):
+        if error:
+            result['errors'] += len(conn.sent) or 1
+        else:
+            # pipelined requests the server closed the connection on
+            result['unanswered'] += len(conn.sent)
+        fd = conn.sock.fileno()
+        epoll.unregister(fd)
+        conn.sock.close()
+        del conns[fd]
+        if time.time() < deadline:
+            connect()
+
+    def complete(conn, end):
+        now = time.time()
+        started = conn.sent.pop(0)
+        if now >= record_from:
+            result['latencies'].append(now - started)
+            result['statuses'][conn.status] = \
+                result['statuses'].get(conn.status, 0) + 1
+            result['bytes'] += end
+        conn.inbuf = conn.inbuf[end:]
+        conn.body_start = None
+
+    def receive(conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                drop(conn, True)
+            return
+        if not data:
+            if conn.body_start is not None and conn.mode == 'close':
+                complete(conn, len(conn.inbuf))
+            drop(conn, False)
+            return
+        conn.inbuf += data
+        while conn.sent:
+            if conn.body_start is None and not _parse_head(conn):
+                break
+            end = _response_end(conn)
+            if end < 0:
+                break
+            close = conn.close
+            complete(conn, end)
+            if close:
+                drop(conn, False)
+                return
+        fill(conn)
+
+    for i in xrange(connections):
+        connect()
+    while conns and time.time() < deadline:
+        for fd, event in epoll.poll(0.1):
+            conn = conns.get(fd)
+            if conn is None:
+                continue
+            if not conn.connected:
+                connected(conn)
+            elif event & select.EPOLLOUT and conn.out:
+                send(conn)
+            if fd in conns and event & (select.EPOLLIN | select.EPOLLHUP |
+                                        select.EPOLLERR):
+                receive(conn)
+    for conn in conns.values():
+        conn.sock.close()
+    epoll.close()
+    return result
+
+
+def start_clients(opts, record_from, deadline):
+    """Fork opts.clients client processes sharing the connections"""
+    clients = []
+    for i in xrange(opts.clients):
+        share = opts.connections // opts.clients + \
+            (i < opts.connections % opts.clients)
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            status = 1
+            try:
+                data = marshal.dumps(
+                    run_client(opts, share, record_from, deadline))
+                while data:
+                    data = data[os.write(w, data):]
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(w)
+        clients.append((pid, r))
+    return clients
+
+
+def collect_clients(clients):
+    """Wait for the client processes and add up their results"""
+    total = {'latencies': [], 'statuses': {}, 'errors': 0, 'unanswered': 0,
+             'connects': 0, 'bytes': 0}
+    for pid, r in clients:
+        chunks = []
+        while True:
+            data = os.read(r, 65536)
+            if not data:
+                break
+            chunks.append(data)
+        os.close(r)
+        os.waitpid(pid, 0)
+        if not chunks:
+            total['errors'] += 1
+            continue
+        result = marshal.loads(''.join(chunks))
+        total['latencies'].extend(result['latencies'])
+        for status, count in result['statuses'].items():
+            total['statuses'][status] = total['statuses'].get(status, 0) + count
+        for key in ('errors', 'unanswered', 'connects', 'bytes'):
+            total[key] += result[key]
+    return total
+
+
+# --- server-side measurements ------------------------------------------
+
+def _process_tree(pid):
+    """Return 'pid' and the pids of all its descendants"""
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        parents.setdefault(ppid, []).append(int(name))
+    pids = [pid]
+    for p in pids:
+        pids.extend(parents.get(p, ()))
+    return pids
+
+
+def _read_proc(pid, name, keys):
+    values = dict.fromkeys(keys, 0)
+    try:
+        with open('/proc/%d/%s' % (pid, name)) as f:
+            for line in f:
+                key, sep, value = line.partition(':')
+                if key in values:
+                    values[key] = int(value.split()[0])
+    except IOError:
+        pass
+    return values
+
+
+def server_stats(pid):
+    """Memory and system activity of a server and its children
+
+    RSS in kB, context switches, and the syscr/syscw counts of
+    /proc/<pid>/io, which cover read()/write()-style calls but not
+    recv(), for instance.
+    """
+    stats = {'rss_kb': 0, 'ctxt_switches': 0, 'syscr': 0, 'syscw': 0}
+    for p in _process_tree(pid):
+        status = _read_proc(p, 'status', ('VmRSS', 'voluntary_ctxt_switches',
+                                          'nonvoluntary_ctxt_switches'))
+        stats['rss_kb'] += status['VmRSS']
+        stats['ctxt_switches'] += (status['voluntary_ctxt_switches'] +
+                                   status['nonvoluntary_ctxt_switches'])
+        io = _read_proc(p, 'io', ('syscr', 'syscw'))
+        stats['syscr'] += io['syscr']
+        stats['syscw'] += io['syscw']
+    return stats
+
+
+def start_strace(pid):
+    """Count all system calls of the server tree with strace, if present"""
+    args = ['strace', '-c', '-f', '-q']
+    for p in _process_tree(pid):
+        args += ['-p', str(p)]
+    try:
+        return subprocess.Popen(args, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+
+
+def stop_strace(proc):
+    """Return the total number of system calls strace counted"""
+    os.kill(proc.pid, signal.SIGINT)
+    output = proc.communicate()[1]
+    end = None
+    for line in output.splitlines():
+        if 'calls' in line and 'syscall' in line:
+            end = line.index('calls') + len('calls')
+        elif line.rstrip().endswith(' total') and end is not None:
+            fields = line[:end].split()
+            if fields and fields[-1].isdigit():
+                return int(fields[-1])
+    return None
+
+
+# --- driver -------------------------------------------------------------
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_listening(port, proc, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with status %d' % proc.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server not listening after %d seconds' % timeout)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, p):
+    """'values' must be sorted"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run_benchmark(opts, app_name):
+    """Benchmark one application; return the results as a dictionary"""
+    opts.port = _free_port()
+    stderr = None if opts.server_log else open(os.devnull, 'w')
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--serve', app_name, '--server', opts.server,
+                             '--port', str(opts.port)], stderr=stderr)
+    try:
+        _wait_listening(opts.port, proc)
+        record_from = time.time() + opts.warmup
+        deadline = record_from + opts.duration
+        clients = start_clients(opts, record_from, deadline)
+
+        # Server counters cover the recorded part of the run only
+        time.sleep(max(0, record_from - time.time()))
+        tracer = start_strace(proc.pid) if opts.strace else None
+        before = server_stats(proc.pid)
+        result = collect_clients(clients)
+        after = server_stats(proc.pid)
+        syscalls = stop_strace(tracer) if tracer is not None else None
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies = sorted(result['latencies'])
+    count = len(latencies)
+    return {
+        'app': app_name,
+        'server': opts.server,
+        'connections': opts.connections,
+        'clients': opts.clients,
+        'keepalive': opts.keepalive,
+        'pipeline': opts.pipeline,
+        'body': opts.body,
+        'path': opts.path,
+        'duration': opts.duration,
+        'requests': count,
+        'rps': round(count / float(opts.duration), 1),
+        'errors': result['errors'],
+        'unanswered': result['unanswered'],
+        'connects': result['connects'],
+        'statuses': dict((str(k), v) for k, v in result['statuses'].items()),
+        'bytes_received': result['bytes'],
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.50)),
+            'p90': _ms(percentile(latencies, 0.90)),
+            'p99': _ms(percentile(latencies, 0.99)),
+            'p999': _ms(percentile(latencies, 0.999)),
+            'max': _ms(latencies[-1] if latencies else None),
+        },
+        'server_rss_kb': after['rss_kb'],
+        'server_ctxt_switches': (after['ctxt_switches'] -
+                                 before['ctxt_switches']),
+        'server_syscr': after['syscr'] - before['syscr'],
+        'server_syscw': after['syscw'] - before['syscw'],
+        'server_syscalls': syscalls,
+    }
+
+
+def format_result(r):
+    lat = r['latency_ms']
+    lines = [
+        '%(app)s on %(server)s: %(connections)d connections, '
+        'keep-alive %(keepalive)s, pipeline %(pipeline)d, body %(body)d' % r,
+        '  %d requests, %.1f req/s, %d errors, %d unanswered' % (
+            r['requests'], r['rps'], r['errors'], r['unanswered']),
+        '  latency ms  p50 %s  p90 %s  p99 %s  p99.9 %s  max %s' % (
+            lat['p50'], lat['p90'], lat['p99'], lat['p999'], lat['max']),
+        '  server RSS %d kB, %d context switches, syscr %d, syscw %d' % (
+            r['server_rss_kb'], r['server_ctxt_switches'], r['server_syscr'],
+            r['server_syscw']),
+    ]
+    if r['server_syscalls'] is not None:
+        lines.append('  %d syscalls in total (strace)' % r['server_syscalls'])
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--app', default='simple,class,stream',
+                        help='applications to run, comma separated: %s'
+                        % ', '.join(sorted(APPS)))
+    parser.add_argument('--server', default='threads', choices=sorted(SERVERS))
+    parser.add_argument('-c', '--connections', type=int, default=50)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--clients', type=int, default=1,
+                        help='client processes to spread connections over')
+    parser.add_argument('--no-keepalive', dest='keepalive',
+                        action='store_false')
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help='requests in flight per connection')
+    parser.add_argument('--body', type=int, default=0,
+                        help='POST a body of this many bytes')
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--strace', action='store_true',
+                        help='count all server system calls with strace')
+    parser.add_argument('--server-log', action='store_true',
+                        help="show the server's log instead of discarding it")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON ('-' for stdout)")
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    opts = parser.parse_args(argv)
+
+    if opts.serve:
+        serve(opts.serve, opts.server, opts.port)
+        return
+
+    results = []
+    for app_name in opts.app.split(','):
+        if app_name not in APPS:
+            parser.error('unknown application %r' % app_name)
+        result = run_benchmark(opts, app_name)
+        results.append(result)
+        sys.stderr.write(format_result(result) + '\n')
+
+    if opts.json:
+        report = {'revision': _git_revision(), 'time': int(time.time()),
+                  'python': sys.version.split()[0], 'results': results}
+        data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        if opts.json == '-':
+            sys.stdout.write(data)
+        else:
+            with open(opts.json, 'w') as f:
+                f.write(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Caching whole responses in memory"""
+
+import time
+import threading
+from collections import OrderedDict
+from util import Headers
+
+__all__ = ['ResponseCache']
+
+# Statuses a shared cache may store without being told to (RFC 7231 6.1)
+_cacheable_statuses = frozenset(['200', '203', '204', '300', '301', '404',
+                                 '405', '410', '414', '501'])
+
+
+def parse_cache_control(value):
+    """Split a Cache-Control value into a dictionary of directives"""
+    directives = {}
+    for item in value.split(','):
+        name, sep, arg = item.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"')
+    return directives
+
+
+class _Entry(object):
+    """A stored response"""
+
+    __slots__ = ('status', 'headers', 'body', 'size', 'stored', 'expires')
+
+    def __init__(self, status, headers, body, ttl):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+        self.stored = time.time()
+        self.expires = self.stored + ttl
+
+
+class _Passthrough(object):
+    """The rest of a response too large to store, after its first blocks"""
+
+    def __init__(self, head, rest, result):
+        self.head = head
+        self.rest = rest
+        self.result = result
+
+    def __iter__(self):
+        for data in self.head:
+            yield data
+        for data in self.rest:
+            yield data
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+class ResponseCache(object):
+    """WSGI middleware answering repeated GET and HEAD requests from memory
+
+    Responses are keyed by path, query string and the request headers
+    named in 'vary', and kept for their Cache-Control max-age (s-maxage
+    first), or 'ttl' seconds when they give none.  Responses that are
+    private, no-store, set cookies, vary on headers not in 'vary', or are
+    larger than 'max_entry_size' are not stored; requests with
+    credentials always go to the application.  Once entries take more
+    than 'max_size' bytes the least recently used are dropped.
+
+    Concurrent misses for the same key are coalesced: one request calls
+    the application while the others wait up to 'wait_timeout' seconds
+    for its response.  They are let go as soon as its headers show it
+    won't be stored, and for 'uncacheable_ttl' seconds after that
+    requests for the key go straight to the application.
+    """
+
+    # Keys remembered as not cacheable, at most
+    max_uncacheable = 10000
+
+    def __init__(self, app, ttl=60, max_size=64 << 20, max_entry_size=1 << 20,
+                 vary=('Accept-Encoding',), wait_timeout=10,
+                 uncacheable_ttl=10):
+        self.app = app
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.vary_keys = tuple('HTTP_' + name.upper().replace('-', '_')
+                               for name in vary)
+        self.vary_names = frozenset(name.lower() for name in vary)
+        self.wait_timeout = wait_timeout
+        self.uncacheable_ttl = uncacheable_ttl
+        self.entries = OrderedDict()    # key -> _Entry, oldest first
+        self.uncacheable = OrderedDict()    # key -> expiry time
+        self.size = 0
+        self.filling = {}               # key -> Event set once it's decided
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD') or 'HTTP_AUTHORIZATION' in environ:
+            return self.app(environ, start_response)
+
+        key = self.key(environ)
+        request_cc = parse_cache_control(environ.get('HTTP_CACHE_CONTROL', ''))
+        if 'no-cache' in request_cc or \
+                environ.get('HTTP_PRAGMA', '').lower() == 'no-cache':
+            entry = None
+        else:
+            entry = self.lookup(key)
+        if entry is None:
+            if method == 'HEAD':
+                # Its empty body would be served to GET requests later
+                return self.app(environ, start_response)
+            with self.lock:
+                uncacheable = self.is_uncacheable(key)
+                if not uncacheable:
+                    event = self.filling.get(key)
+                    filler = event is None
+                    if filler:
+                        event = self.filling[key] = threading.Event()
+            if uncacheable:
+                return self.app(environ, start_response)
+            if not filler:
+                event.wait(self.wait_timeout)
+                entry = self.lookup(key)
+                if entry is None:
+                    # Not cacheable after all, or too slow: ask ourselves
+                    return self.app(environ, start_response)
+        if entry is not None:
+            return self.serve(entry, method, start_response)
+
+        try:
+            return self.fill(key, event, environ, start_response)
+        finally:
+            self.release(key, event)
+
+    def release(self, key, event):
+        """Let the requests waiting for 'key' go"""
+        with self.lock:
+            if self.filling.get(key) is event:
+                del self.filling[key]
+        event.set()
+
+    def is_uncacheable(self, key):
+        """Was 'key' found not cacheable lately?  Call with the lock held"""
+        expires = self.uncacheable.get(key)
+        if expires is None:
+            return False
+        if expires <= time.time():
+            del self.uncacheable[key]
+            return False
+        return True
+
+    def mark_uncacheable(self, key, event):
+        with self.lock:
+            self.uncacheable.pop(key, None)
+            self.uncacheable[key] = time.time() + self.uncacheable_ttl
+            while len(self.uncacheable) > self.max_uncacheable:
+                self.uncacheable.popitem(last=False)
+        self.release(key, event)
+
+    def key(self, environ):
+        return (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                environ.get('QUERY_STRING', ''),
+                tuple(environ.get(key) for key in self.vary_keys))
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                del self.entries[key]
+                self.size -= entry.size
+                return None
+            del self.entries[key]       # most recently used goes last
+            self.entries[key] = entry
+            return entry
+
+    def serve(self, entry, method, start_response):
+        age = int(time.time() - entry.stored)
+        start_response(entry.status, entry.headers + [('Age', str(age))])
+        if method == 'HEAD':
+            return []
+        return [entry.body]
+
+    def fill(self, key, event, environ, start_response):
+        """Call the application, storing its response if allowed"""
+        response = {}
+        chunks = []
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            response['ttl'] = ttl = self.cacheable(status, headers)
+            if not ttl:
+                self.mark_uncacheable(key, event)
+            return chunks.append
+
+        result = self.app(environ, capture)
+        size = sum(len(data) for data in chunks)
+        rest = iter(result)
+        complete = False
+        try:
+            # Stop buffering once the headers show the response won't be
+            # stored, so streaming responses aren't held back
+            if response.get('ttl', 1):
+                for data in rest:
+                    chunks.append(data)
+                    size += len(data)
+                    if size > self.max_entry_size or not response['ttl']:
+                        break
+                else:
+                    complete = True
+        except:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+        if complete and hasattr(result, 'close'):
+            result.close()
+        if 'status' not in response:
+            raise AssertionError("start_response() not called")
+        status, headers = response['status'], response['headers']
+
+        if not complete:
+            if response['ttl']:
+                self.mark_uncacheable(key, event)
+            start_response(status, headers)
+            return _Passthrough(chunks, rest, result)
+        body = ''.join(chunks)
+        ttl = response['ttl']
+        if ttl:
+            headers = list(headers)
+            h = Headers(headers)
+            if 'Content-Length' not in h and status[:3] != '204':
+                h['Content-Length'] = str(len(body))
+            self.store(key, _Entry(status, headers, body, ttl))
+        start_response(status, headers)
+        return [body]
+
+    def cacheable(self, status, headers):
+        """Return how long the response may be kept, 0 for not at all"""
+        if status[:3] not in _cacheable_statuses:
+            return 0
+        h = Headers(list(headers))
+        if 'Set-Cookie' in h:
+            return 0
+        length = h.get('Content-Length', '')
+        if length.isdigit() and int(length) > self.max_entry_size:
+            return 0
+        cc = parse_cache_control(','.join(h.get_all('Cache-Control')))
+        if 'no-store' in cc or 'private' in cc or 'no-cache' in cc:
+            return 0
+        vary = set(name.strip().lower()
+                   for name in ','.join(h.get_all('Vary')).split(',')
+                   if name.strip())
+        if not vary <= self.vary_names:
+            return 0                    # includes 'Vary: *'
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cc:
+                try:
+                    return max(0, int(cc[directive]))
+                except ValueError:
+                    return 0
+        return self.ttl
+
+    def store(self, key, entry):
+        if entry.size > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
@@ -0,0 +1,425 @@
+"""Running CGI scripts from a WSGI application"""
+
+import os
+import re
+import sys
+import errno
+import select
+import signal
+import marshal
+import threading
+import subprocess
+import Queue
+import time
+from protocol import find_head_end, RequestError
+from util import is_hop_by_hop
+
+__all__ = ['CGIApplication']
+
+# Request meta-variables of RFC 3875 copied from the WSGI environ
+_cgi_vars = (
+    'AUTH_TYPE', 'CONTENT_LENGTH', 'CONTENT_TYPE', 'QUERY_STRING',
+    'REMOTE_ADDR', 'REMOTE_HOST', 'REMOTE_IDENT', 'REMOTE_USER',
+    'REQUEST_METHOD', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL',
+    'HTTPS',
+)
+
+# A header field name (RFC 7230 token) followed by a colon
+_header_line = re.compile(r"^[-!#$%&'*+.^_`|~0-9A-Za-z]+:")
+
+try:
+    MAXFD = os.sysconf('SC_OPEN_MAX')
+except (AttributeError, ValueError):
+    MAXFD = 256
+
+
+class _Helper(object):
+    """A forked process waiting to become a CGI script
+
+    The fork happens ahead of time; run() sends the script and environment
+    over a control pipe, and the helper either exec()s the script or, for
+    persistent Python scripts, runs it in the already started interpreter.
+    Offers the parts of the subprocess.Popen interface the gateway uses.
+    """
+
+    def __init__(self):
+        control_r, control_w = os.pipe()
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.dup2(stdin_r, 0)
+                os.dup2(stdout_w, 1)
+                os.dup2(control_r, 3)
+                os.closerange(4, MAXFD)     # sockets of other clients too
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.child()
+            finally:
+                os._exit(127)
+        for fd in (control_r, stdin_r, stdout_w):
+            os.close(fd)
+        self.control = control_w
+        self.stdin = os.fdopen(stdin_w, 'wb')
+        self.stdout = os.fdopen(stdout_r, 'rb')
+        self.returncode = None
+
+    def child(self):
+        chunks = []
+        while True:
+            data = os.read(3, 65536)
+            if not data:
+                break
+            chunks.append(data)
+        os.close(3)
+        if not chunks:
+            os._exit(0)                     # the pool was shut down
+        filename, env, persistent = marshal.loads(''.join(chunks))
+        os.chdir(os.path.dirname(filename))
+        if not persistent:
+            os.execve(filename, [filename], env)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = [filename]
+        sys.stdin = os.fdopen(0, 'rb')
+        sys.stdout = os.fdopen(1, 'wb')
+        status = 0
+        try:
+            execfile(filename, {'__name__': '__main__', '__file__': filename})
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                status = 1
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        os._exit(status)
+
+    def run(self, filename, env, persistent):
+        data = marshal.dumps((filename, env, persistent))
+        while data:
+            data = data[os.write(self.control, data):]
+        os.close(self.control)
+        self.control = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = status
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, self.returncode = os.waitpid(self.pid, 0)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class _HelperPool(object):
+    """Keep 'size' helpers forked, refilled by a background thread"""
+
+    def __init__(self, size):
+        self.size = size
+        self.ready = Queue.Queue()
+        self.wanted = threading.Semaphore(size)
+        self.thread = threading.Thread(target=self.refill, name='cgi-spawner')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def refill(self):
+        while True:
+            self.wanted.acquire()
+            self.ready.put(_Helper())
+
+    def get(self):
+        try:
+            helper = self.ready.get_nowait()
+        except Queue.Empty:
+            return _Helper()                # pool drained: fork right now
+        self.wanted.release()
+        return helper
+
+
+class _CGIResponse(object):
+    """Iterate over a script's output after its headers, then reap it"""
+
+    def __init__(self, gateway, proc, feeder, data, deadline):
+        self.gateway = gateway
+        self.proc = proc
+        self.feeder = feeder
+        self.data = data
+        self.deadline = deadline
+        self.finished = False
+
+    def __iter__(self):
+        if self.data:
+            yield self.data
+            self.data = None
+        while True:
+            data = self.gateway.read_output(self.proc, self.deadline)
+            if not data:
+                break
+            yield data
+        self.finished = True
+
+    def close(self):
+        # A script done with its output may still have work to finish;
+        # one whose response was cut short is killed.
+        if self.finished:
+            self.gateway.reap(self.proc, self.feeder, self.deadline)
+        else:
+            self.gateway.reap(self.proc, self.feeder)
+
+
+class CGIApplication(object):
+    """WSGI application running the CGI scripts in 'script_dir'
+
+    A request for 'prefix' + 'name' + extra path runs the script 'name'
+    with the RFC 3875 environment, feeds it the request body and streams
+    its output back after turning the CGI header block into the WSGI
+    status and headers.  Scripts get 'timeout' seconds to finish.
+
+    With 'pool_size' the gateway keeps that many processes forked in
+    advance, so a request doesn't pay for fork().  Python scripts named in
+    'persistent' are run inside those pre-forked interpreters instead of
+    being exec()ed, which also saves the interpreter start-up.
+    """
+
+    max_header_size = 65536
+
+    def __init__(self, script_dir, prefix='/cgi-bin/', timeout=30,
+                 pool_size=0, persistent=()):
+        self.script_dir = os.path.abspath(script_dir)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.persistent = frozenset(persistent)
+        self.pool_size = pool_size
+        self.pool = self.pool_pid = None
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.error(start_response, '404 Not Found')
+        script = self.find_script(path[len(self.prefix):])
+        if script is None:
+            return self.error(start_response, '404 Not Found')
+        name, filename, path_info = script
+        env = self.cgi_environ(environ, self.prefix + name, path_info,
+                               filename)
+
+        deadline = time.time() + self.timeout
+        proc = self.spawn(name, filename, env)
+        feeder = self.feed_input(proc, environ)
+
+        try:
+            status, headers, data = self.read_headers(proc, deadline)
+        except Exception:
+            self.reap(proc, feeder)
+            raise
+        if status is None:
+            self.reap(proc, feeder)
+            return self.error(start_response, headers)
+        start_response(status, headers)
+        return _CGIResponse(self, proc, feeder, data, deadline)
+
+    def find_script(self, path):
+        """Split 'path' into (script name, file name, extra path)"""
+        parts = path.split('/')
+        if '..' in parts or '\0' in path:
+            return None
+        for i in range(1, len(parts) + 1):
+            name = '/'.join(parts[:i])
+            filename = os.path.join(self.script_dir, name)
+            if os.path.isfile(filename):
+                if name in self.persistent or os.access(filename, os.X_OK):
+                    rest = '/'.join(parts[i:])
+                    return name, filename, rest and '/' + rest
+                return None
+            if not os.path.isdir(filename):
+                return None
+        return None
+
+    def cgi_environ(self, environ, script_name, path_info, filename):
+        env = {'PATH': os.environ.get('PATH', '/usr/bin:/bin')}
+        for key, value in environ.items():
+            if type(value) is str and (key.startswith('HTTP_') or
+                                       key in _cgi_vars) and \
+                    '\0' not in value:     # execve() can't pass it
+                env[key] = value
+        env.pop('HTTP_PROXY', None)     # would be taken for a proxy setting
+        if not env.get('CONTENT_LENGTH'):
+            env.pop('CONTENT_LENGTH', None)
+        env['GATEWAY_INTERFACE'] = 'CGI/1.1'
+        env['SERVER_SOFTWARE'] = 'WSGIServer'
+        env['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + script_name
+        env['SCRIPT_FILENAME'] = filename
+        env['PATH_INFO'] = path_info
+        if path_info:
+            env['PATH_TRANSLATED'] = os.path.join(self.script_dir,
+                                                  path_info.lstrip('/'))
+        env['REDIRECT_STATUS'] = '200'
+        return env
+
+    def spawn(self, name, filename, env):
+        if self.pool_size:
+            # Helpers must be our own children, not those of the process
+            # that created the application before a pre-forking server
+            # forked its workers.
+            if self.pool_pid != os.getpid():
+                self.pool = _HelperPool(self.pool_size)
+                self.pool_pid = os.getpid()
+            helper = self.pool.get()
+            helper.run(filename, env, name in self.persistent)
+            return helper
+        if name in self.persistent:
+            args = [sys.executable, filename]
+        else:
+            args = [filename]
+        return subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=os.path.dirname(filename), env=env, close_fds=True
+        )
+
+    def feed_input(self, proc, environ):
+        """Copy the request body to the script's stdin from a thread
+
+        A thread keeps a script that answers before reading all of its
+        input from deadlocking against us.  Returns the thread, or None if
+        there is no body; it reads from the client connection, so reap()
+        must stop it before the request is over.
+
+        The first block is read here, so anything the server writes when
+        the body is first read, like "100 Continue", is written by the
+        request's own thread.
+        """
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        try:
+            first = length > 0 and \
+                environ['wsgi.input'].read(min(length, 65536))
+        except (IOError, OSError, RequestError):
+            first = ''
+        if not first:
+            proc.stdin.close()
+            return None
+        abort = threading.Event()
+
+        def copy():
+            data = first
+            left = length - len(data)
+            try:
+                proc.stdin.write(data)
+                while left > 0 and not abort.is_set():
+                    data = environ['wsgi.input'].read(min(left, 65536))
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    left -= len(data)
+            except (IOError, OSError, RequestError):
+                pass                        # the script or client quit
+            finally:
+                try:
+                    proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        t = threading.Thread(target=copy, name='cgi-input')
+        t.daemon = True
+        t.abort = abort
+        t.start()
+        return t
+
+    def read_output(self, proc, deadline):
+        """Read the next block of output; '' at the end or on timeout"""
+        fd = proc.stdout.fileno()
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                proc.kill()
+                return ''
+            try:
+                r, w, x = select.select([fd], [], [], timeout)
+                if r:
+                    return os.read(fd, 65536)
+            except (OSError, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def read_headers(self, proc, deadline):
+        """Return (status, headers, start of body) from the script output
+
+        On failure status is None and headers the error status to send.
+        Output that doesn't start with a header, like cgi_hello.sh's, is
+        all taken as an HTML body, as cgi-fcgi/cgi.c does.
+        """
+        data = ''
+        while True:
+            end, blank = find_head_end(data)
+            if end >= 0:
+                break
+            if '\n' in data and not _header_line.match(data):
+                return '200 OK', [('Content-Type', 'text/html')], data
+            if len(data) > self.max_header_size:
+                return None, '502 Bad Gateway', ''
+            chunk = self.read_output(proc, deadline)
+            if not chunk:
+                if time.time() >= deadline:
+                    return None, '504 Gateway Timeout', ''
+                return None, '502 Bad Gateway', ''
+            data += chunk
+
+        status = None
+        headers = []
+        for line in data[:end].splitlines():
+            name, sep, value = line.partition(':')
+            name, value = name.strip(), value.strip()
+            if not sep or not name:
+                return None, '502 Bad Gateway', ''
+            if name.lower() == 'status':
+                status = value
+            elif not is_hop_by_hop(name):
+                headers.append((name, value))
+        if status is None:
+            if any(name.lower() == 'location' for name, value in headers):
+                status = '302 Found'
+            else:
+                status = '200 OK'
+        return status, headers, data[end + blank:]
+
+    def reap(self, proc, feeder=None, deadline=None):
+        """Wait for the script to exit until 'deadline', then kill it"""
+        delay = 0.001
+        while deadline is not None and proc.poll() is None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            time.sleep(min(delay, timeout))
+            delay = min(delay * 2, 0.05)
+        if proc.poll() is None:
+            proc.kill()
+        if feeder is not None:
+            # With the script gone its writes fail, if it isn't done yet
+            feeder.abort.set()
+            feeder.join()
+        proc.stdout.close()
+        proc.wait()
+
+    def error(self, start_response, status):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [status + '\n']
@@ -0,0 +1,197 @@
+"""Compressing responses with gzip or deflate"""
+
+import zlib
+from types import ListType, TupleType
+from util import Headers
+
+__all__ = ['Compress']
+
+_default_types = frozenset([
+    'application/javascript', 'application/json', 'application/xml',
+    'application/xhtml+xml', 'application/x-javascript', 'image/svg+xml',
+])
+
+
+def negotiate(accept_encoding):
+    """Return 'gzip', 'deflate' or None for an Accept-Encoding value"""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, sep, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            qualities[coding] = q
+    best = None
+    for coding in ('gzip', 'deflate'):
+        q = qualities.get(coding, qualities.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = coding, q
+    return best and best[0]
+
+
+class _Response(object):
+    """One response passing through Compress
+
+    The application's start_response() call is held back until the body
+    starts, or the application returns a list, so the decision to compress
+    can take a small body's size into account.
+    """
+
+    def __init__(self, middleware, environ, start_response):
+        self.middleware = middleware
+        self.coding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        self.real_start_response = start_response
+        self.status = self.headers = None
+        self.started = False
+        self.compressor = None
+        self.result = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info and self.started:
+            try:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def choose(self, size=None):
+        """Decide whether to compress and adjust the headers to it"""
+        headers = Headers(self.headers)
+        if not self.middleware.compressible(self.status, headers):
+            return headers
+        vary = headers.get('Vary')
+        if vary is None:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower() and vary != '*':
+            headers['Vary'] = vary + ', Accept-Encoding'
+        if size is None:
+            size = headers.get('Content-Length')
+        if self.coding is None or \
+                (size is not None and int(size) < self.middleware.min_size):
+            return headers
+        self.compressor = self.middleware.compressor(self.coding)
+        headers['Content-Encoding'] = self.coding
+        del headers['Content-Length']
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            # the same entity, but no longer the same bytes
+            headers['ETag'] = 'W/' + etag
+        return headers
+
+    def begin(self, size=None):
+        self.choose(size)
+        self.started = True
+        self.real_write = self.real_start_response(self.status, self.headers)
+
+    def write(self, data):
+        if not self.started:
+            self.begin()
+        if self.compressor is not None:
+            data = self.compress(data)
+        if data:
+            self.real_write(data)
+
+    def compress(self, data):
+        data = self.compressor.compress(data)
+        if self.middleware.sync_flush:
+            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def __call__(self, result):
+        """Return the iterable to hand to the server"""
+        if (self.status is not None and not self.started and
+                type(result) in (ListType, TupleType)):
+            # The whole body is at hand: compress it in one go, so the
+            # server can still send a Content-Length
+            headers = self.choose(sum(len(data) for data in result))
+            if self.compressor is not None:
+                data = self.compressor.compress(''.join(result))
+                result = [data + self.compressor.flush()]
+                headers['Content-Length'] = str(len(result[0]))
+            self.started = True
+            self.real_write = self.real_start_response(self.status,
+                                                       self.headers)
+            return result
+        if self.status is not None and not self.started:
+            self.begin()
+            if self.compressor is None:
+                # Untouched, so a wsgi.file_wrapper still reaches the server
+                return result
+        self.result = result
+        return self
+
+    def __iter__(self):
+        for data in self.result:
+            if not self.started:
+                if self.status is None:
+                    raise AssertionError("body before start_response()")
+                self.begin()
+            if self.compressor is not None:
+                data = self.compress(data)
+            yield data              # even if empty; the app may be pacing
+        if not self.started and self.status is not None:
+            self.begin(0)
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            if data:
+                yield data
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+class Compress(object):
+    """WSGI middleware compressing the responses of 'app'
+
+    Responses are compressed with gzip or deflate, as negotiated with the
+    client's Accept-Encoding, when their Content-Type is text/* or in
+    'types' and they are at least 'min_size' bytes long, if the length is
+    known.  Streaming bodies are compressed block by block as they pass
+    through; 'sync_flush' makes every block leave compressed at once, for
+    applications that pace their output, at some cost in ratio.
+
+    Compressed responses lose their Content-Length, unless the application
+    returned a list, and gain Content-Encoding; compressible ones get
+    "Vary: Accept-Encoding" either way.
+    """
+
+    def __init__(self, app, min_size=256, level=6, types=_default_types,
+                 sync_flush=False):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.types = frozenset(types)
+        self.sync_flush = sync_flush
+
+    def __call__(self, environ, start_response):
+        response = _Response(self, environ, start_response)
+        result = self.app(environ, response.start_response)
+        return response(result)
+
+    def compressible(self, status, headers):
+        if status[:3] in ('204', '206', '304') or status[:1] == '1':
+            return False
+        if 'Content-Encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', '').lower():
+            return False
+        content_type = headers.get('Content-Type', '')
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        return content_type.startswith('text/') or content_type in self.types
+
+    def compressor(self, coding):
+        if coding == 'gzip':
+            wbits = 16 + zlib.MAX_WBITS     # gzip header and trailer
+        else:
+            wbits = zlib.MAX_WBITS          # "deflate" means the zlib format
+        return zlib.compressobj(self.level, zlib.DEFLATED, wbits)
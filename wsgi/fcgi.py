@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""FastCGI responder: run WSGI applications behind a FastCGI web server
+
+Record layout and constants follow cgi-fcgi/fastcgi.h.
+"""
+
+import sys
+import struct
+import socket
+import urllib
+from cStringIO import StringIO
+from handlers import SimpleHandler
+from protocol import SocketReader
+from server import WSGIServer, make_server
+
+__all__ = ['FCGIRequestHandler', 'FCGIServer']
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_NULL_REQUEST_ID = 0
+FCGI_KEEP_CONN = 1
+
+FCGI_RESPONDER = 1
+
+FCGI_REQUEST_COMPLETE = 0
+FCGI_UNKNOWN_ROLE = 3
+
+FCGI_MAX_CONTENT = 65535
+
+_header = struct.Struct('!BBHHBx')          # FCGI_Header
+_begin_request = struct.Struct('!HB5x')     # FCGI_BeginRequestBody
+_end_request = struct.Struct('!LB3x')       # FCGI_EndRequestBody
+_unknown_type = struct.Struct('!B7x')       # FCGI_UnknownTypeBody
+
+
+def decode_pairs(data):
+    """Decode FastCGI name-value pairs into a dictionary"""
+    pairs = {}
+    pos = 0
+    while pos < len(data):
+        name_length, pos = _decode_length(data, pos)
+        value_length, pos = _decode_length(data, pos)
+        name = data[pos:pos + name_length]
+        pos += name_length
+        pairs[name] = data[pos:pos + value_length]
+        pos += value_length
+    return pairs
+
+
+def _decode_length(data, pos):
+    if ord(data[pos]) >> 7:
+        return struct.unpack('!L', data[pos:pos + 4])[0] & 0x7fffffff, pos + 4
+    return ord(data[pos]), pos + 1
+
+
+def encode_pair(name, value):
+    lengths = []
+    for n in (len(name), len(value)):
+        if n < 128:
+            lengths.append(chr(n))
+        else:
+            lengths.append(struct.pack('!L', n | 0x80000000))
+    return ''.join(lengths) + name + value
+
+
+class FCGIStream(object):
+    """Write-only file sending its data as STDOUT or STDERR records"""
+
+    def __init__(self, conn, record_type, request_id):
+        self.conn = conn
+        self.record_type = record_type
+        self.request_id = request_id
+
+    def write(self, data):
+        for pos in xrange(0, len(data), FCGI_MAX_CONTENT):
+            self.conn.send_record(self.record_type, self.request_id,
+                                  data[pos:pos + FCGI_MAX_CONTENT])
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Send the empty record that ends the stream"""
+        self.conn.send_record(self.record_type, self.request_id, '')
+
+
+class FCGIHandler(SimpleHandler):
+    """SimpleHandler for a request forwarded by the web server"""
+
+    origin_server = False
+
+
+class FCGIRequest(object):
+    """A request whose records are still arriving"""
+
+    __slots__ = ('keep_conn', 'params', 'stdin', 'stdin_size')
+
+    def __init__(self, keep_conn):
+        self.keep_conn = keep_conn
+        self.params = []
+        self.stdin = []
+        self.stdin_size = 0
+
+
+class FCGIRequestHandler(object):
+    """Speak the FastCGI responder protocol on one web server connection
+
+    Records of several requests may be interleaved on the connection; each
+    request is collected separately and run once its STDIN stream ends.
+    Requests run one at a time, so FCGI_MPXS_CONNS is reported as 0.  The
+    connection is kept open between requests when the web server asks for
+    it with FCGI_KEEP_CONN.  Bodies over 'max_body_size' are discarded as
+    they arrive and answered with 413.
+    """
+
+    timeout = 60
+    max_requests = 1000
+    max_body_size = 64 << 20
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def setup(self):
+        self.connection = self.request
+        self.connection.settimeout(self.timeout)
+        self.rfile = SocketReader(self.connection)
+        self.wfile = self.connection.makefile('wb', 0)
+        self.requests = {}
+        self.request_count = 0
+        self.close_connection = 0
+
+    def handle(self):
+        while not self.close_connection:
+            try:
+                record = self.read_record()
+            except (socket.timeout, struct.error):
+                break
+            if record is None:
+                break
+            self.handle_record(*record)
+
+    def read_record(self):
+        header = self.rfile.read(_header.size)
+        if len(header) < _header.size:
+            return None
+        version, record_type, request_id, length, padding = \
+            _header.unpack(header)
+        content = self.rfile.read(length)
+        if len(content) < length or len(self.rfile.read(padding)) < padding:
+            return None
+        return record_type, request_id, content
+
+    def send_record(self, record_type, request_id, content):
+        self.wfile.write(_header.pack(FCGI_VERSION_1, record_type, request_id,
+                                      len(content), 0) + content)
+
+    def handle_record(self, record_type, request_id, content):
+        if request_id == FCGI_NULL_REQUEST_ID:
+            self.handle_management_record(record_type, content)
+            return
+
+        if record_type == FCGI_BEGIN_REQUEST:
+            role, flags = _begin_request.unpack(content)
+            if role != FCGI_RESPONDER:
+                self.end_request(request_id, FCGI_UNKNOWN_ROLE)
+            else:
+                self.requests[request_id] = FCGIRequest(flags & FCGI_KEEP_CONN)
+            return
+
+        req = self.requests.get(request_id)
+        if req is None:
+            return                          # not (or no longer) active
+        if record_type == FCGI_PARAMS:
+            req.params.append(content)
+        elif record_type == FCGI_STDIN:
+            if content:
+                req.stdin_size += len(content)
+                if req.stdin_size <= self.max_body_size:
+                    req.stdin.append(content)
+                else:
+                    req.stdin = []
+            else:
+                del self.requests[request_id]
+                self.run_request(request_id, req)
+        elif record_type == FCGI_ABORT_REQUEST:
+            del self.requests[request_id]
+            self.end_request(request_id, FCGI_REQUEST_COMPLETE)
+            if not req.keep_conn:
+                self.close_connection = 1
+
+    def handle_management_record(self, record_type, content):
+        if record_type == FCGI_GET_VALUES:
+            values = {
+                'FCGI_MAX_CONNS': str(getattr(self.server, 'workers', 1)),
+                'FCGI_MAX_REQS': str(getattr(self.server, 'workers', 1)),
+                'FCGI_MPXS_CONNS': '0',
+            }
+            result = [encode_pair(name, values[name])
+                      for name in decode_pairs(content) if name in values]
+            self.send_record(FCGI_GET_VALUES_RESULT, FCGI_NULL_REQUEST_ID,
+                             ''.join(result))
+        else:
+            self.send_record(FCGI_UNKNOWN_TYPE, FCGI_NULL_REQUEST_ID,
+                             _unknown_type.pack(record_type))
+
+    def get_environ(self, req):
+        env = decode_pairs(''.join(req.params))
+        if not env.get('PATH_INFO'):
+            # nginx's fastcgi_params only pass the full request URI
+            path = env.get('DOCUMENT_URI') or \
+                env.get('REQUEST_URI', '').split('?', 1)[0]
+            env['PATH_INFO'] = urllib.unquote(path)
+            env['SCRIPT_NAME'] = ''
+        return env
+
+    def run_request(self, request_id, req):
+        stdout = FCGIStream(self, FCGI_STDOUT, request_id)
+        stderr = FCGIStream(self, FCGI_STDERR, request_id)
+        if req.stdin_size > self.max_body_size:
+            app = self.body_too_large
+        else:
+            app = self.server.get_app()
+        handler = FCGIHandler(
+            StringIO(''.join(req.stdin)), stdout, stderr,
+            self.get_environ(req),
+            multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess
+        )
+        handler.run(app)
+        stdout.close()
+        self.end_request(request_id, FCGI_REQUEST_COMPLETE)
+
+        self.request_count += 1
+        if not req.keep_conn or self.request_count >= self.max_requests:
+            self.close_connection = 1
+
+    def body_too_large(self, environ, start_response):
+        start_response('413 Request Entity Too Large',
+                       [('Content-Type', 'text/plain')])
+        return ['413 Request Entity Too Large\n']
+
+    def end_request(self, request_id, protocol_status, app_status=0):
+        self.send_record(FCGI_END_REQUEST, request_id,
+                         _end_request.pack(app_status, protocol_status))
+
+    def finish(self):
+        if not self.wfile.closed:
+            try:
+                self.wfile.flush()
+            except socket.error:
+                pass
+        self.wfile.close()
+        self.rfile.close()
+
+
+class FCGIServer(WSGIServer):
+    """WSGIServer accepting FastCGI connections from a web server"""
+
+    def __init__(self, server_address,
+                 RequestHandlerClass=FCGIRequestHandler):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+
+if __name__ == "__main__":
+    from app import simple_app
+    # nginx: fastcgi_pass 127.0.0.1:9000; include fastcgi_params;
+    make_server("127.0.0.1", 9000, simple_app,
+                handler_class=FCGIRequestHandler, workers=4)
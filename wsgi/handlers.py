@@ -1,13 +1,21 @@
 """Base classes for server/gateway implementations"""
 
-from types import StringType
+from types import StringType, ListType, TupleType
 import sys, os, time
-import mimetools
+import stat
+import mmap
+import errno
+import select
 import urllib
 import socket
-from util import is_hop_by_hop, Headers, format_date_time
+from util import is_hop_by_hop, Headers, cached_date_time
+from util import FileWrapper, sendfile, parse_byte_range
+from protocol import SocketReader, RequestBody, RequestError, parse_head
+from protocol import head_complete
+from protocol import uwsgi_header, parse_uwsgi_vars
 
-__all__ = ['WSGIRequestHandler', 'SimpleHandler']
+__all__ = ['WSGIRequestHandler', 'EventRequestHandler',
+           'UWSGIRequestHandler', 'SimpleHandler']
 
 
 class WSGIRequestHandler(object):
@@ -16,7 +24,39 @@ class WSGIRequestHandler(object):
     wbufsize = 0
     timeout = 10
 
+    # Persistent connections: how long to wait for the next request on an
+    # idle connection, and how many requests to serve before closing it.
+    # The wait holds a thread or process of the blocking servers, so it is
+    # given up, every 'keepalive_poll' seconds, as soon as other clients
+    # wait for the server.  EpollWSGIServer and AsyncWSGIServer keep idle
+    # connections without holding anything; use them for many idle clients.
+    keepalive_timeout = 5
+    keepalive_poll = 0.05
+    max_requests = 100
+
+    # Limits on the request line and headers
+    max_head_size = 65536
+    max_headers = 100
+
+    # Largest request body accepted, and how much of a body the application
+    # left unread is skipped to keep the connection; more closes it.
+    max_body_size = 64 << 20
+    max_drain = 65536
+
+    # With pipelining, up to this many bytes ending a response are held
+    # back while the next request, already buffered, is parsed; they are
+    # written before its application is called, or with its error.
+    max_held_output = 65536
+    held_output = ''
+
     default_request_version = "HTTP/1.1"
+    requestline = ''
+    command = None
+    path = request_version = '-'
+    request_start = None
+
+    # Whether bodies of unknown length may be sent chunked to the peer
+    chunked_responses = True
 
     def __init__(self, request, client_address, server):
         self.request = request
@@ -34,12 +74,13 @@ class WSGIRequestHandler(object):
         self.connection = self.request
         self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
         self.connection.settimeout(self.timeout)
-        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.rfile = SocketReader(self.connection, bufsize=self.rbufsize)
         self.wfile = self.connection.makefile('wb', self.wbufsize)
 
     def address_string(self):
+        """Client host name if already resolved, else its address"""
         host, port = self.client_address[:2]
-        return socket.getfqdn(host)
+        return self.server.hostnames.lookup(host) or host
 
     def get_environ(self):
         env = self.server.base_environ.copy()
@@ -53,39 +94,27 @@ class WSGIRequestHandler(object):
         env['PATH_INFO'] = urllib.unquote(path)
         env['QUERY_STRING'] = query
 
-        host = self.address_string()
-        if host != self.client_address[0]:
-            env['REMOTE_HOST'] = host
+        if self.server.resolve_hostnames:
+            host = self.address_string()
+            if host != self.client_address[0]:
+                env['REMOTE_HOST'] = host
         env['REMOTE_ADDR'] = self.client_address[0]
 
-        if self.headers.typeheader is None:
-            env['CONTENT_TYPE'] = self.headers.type
-        else:
-            env['CONTENT_TYPE'] = self.headers.typeheader
-
-        length = self.headers.getheader('content-length')
-        if length:
-            env['CONTENT_LENGTH'] = length
-
-        for h in self.headers.headers:
-            k,v = h.split(':',1)
-            k=k.replace('-','_').upper(); v=v.strip()
-            if k in env:
-                continue                    # skip content length, type,etc.
-            if 'HTTP_'+k in env:
-                env['HTTP_'+k] += ','+v     # comma-separate multiple headers
-            else:
-                env['HTTP_'+k] = v
+        env['CONTENT_TYPE'] = 'text/plain'
+        env.update(self.headers)
         return env
 
     def parse_request(self):
         """Parse a request (internal).
+
+        'self.headers' maps the CGI names of the request headers to their
+        values, ready to be merged into the environ.
         """
         self.command = None  # set in case of error on the first line
+        self.path = '-'
         self.request_version = version = self.default_request_version
         self.close_connection = 1
-        requestline = self.raw_requestline
-        requestline = requestline.rstrip('\r\n')
+        requestline, self.headers = parse_head(self.raw_head, self.max_headers)
         self.requestline = requestline
         words = requestline.split()
 
@@ -93,42 +122,201 @@ class WSGIRequestHandler(object):
             command, path, version = words
         elif len(words) == 2:
             command, path = words
-        elif not words:
-            return False
         else:
-            return False
+            raise RequestError(400, 'Bad request line %r' % requestline)
         self.command, self.path, self.request_version = command, path, version
 
-        # Examine the headers and look for a Connection directive
-        self.headers = self.MessageClass(self.rfile, 0)
-
-        conntype = self.headers.get('Connection', "")
-        if conntype.lower() == 'keep-alive':
+        # HTTP/1.1 connections persist unless the client asks otherwise,
+        # HTTP/1.0 ones only when the client asks for it.
+        conntype = self.headers.get('HTTP_CONNECTION', "").lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif conntype == 'keep-alive':
             self.close_connection = 0
+        elif len(words) == 3 and version >= 'HTTP/1.1':
+            self.close_connection = 0
+
+        te = self.headers.get('HTTP_TRANSFER_ENCODING')
+        length = self.headers.get('CONTENT_LENGTH')
+        if te is not None:
+            if te.lower() != 'chunked':
+                raise RequestError(501, 'Unsupported transfer coding %r' % te)
+            if length is not None:
+                # RFC 7230 3.3.3: the length is ignored, and not trusted
+                del self.headers['CONTENT_LENGTH']
+                self.close_connection = 1
+            self.body_length, self.body_chunked = 0, True
+        else:
+            try:
+                self.body_length = int(length or 0)
+            except ValueError:
+                self.body_length = -1
+            if self.body_length < 0:
+                raise RequestError(400, 'Bad Content-Length %r' % length)
+            if self.body_length > self.max_body_size:
+                raise RequestError(413, 'Request body too large')
+            self.body_chunked = False
+
+        expect = self.headers.get('HTTP_EXPECT')
+        self.expect_continue = False
+        if expect is not None:
+            if expect.lower() != '100-continue':
+                raise RequestError(417, 'Unsupported expectation %r' % expect)
+            self.expect_continue = (len(words) == 3 and
+                                    version >= 'HTTP/1.1')
         return True
 
     def handle(self):
+        """Handle HTTP requests until the connection should be closed"""
+        self.request_count = 0
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if not head_complete(self.rfile.buffer):
+                self.write_held()
+                if not self.wait_for_request():
+                    self.close_connection = 1
+                    break
+                self.connection.settimeout(self.keepalive_timeout)
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait on an idle connection for the client's next request
+
+        Returns False once 'keepalive_timeout' passes, or when other
+        clients are waiting for the server.
+        """
+        deadline = time.time() + self.keepalive_timeout
+        poller = select.poll()
+        poller.register(self.connection, select.POLLIN)
+        while True:
+            timeout = min(deadline - time.time(), self.keepalive_poll)
+            if timeout <= 0:
+                return False
+            try:
+                if poller.poll(timeout * 1000):
+                    return True
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    return False
+                continue
+            if self.server.requests_waiting():
+                return False
+
+    def handle_one_request(self):
         """Handle a single HTTP request"""
-
-        self.raw_requestline = self.rfile.readline(65537)
-        if not self.parse_request():
+        self.request_start = None
+        try:
+            self.raw_head = self.rfile.read_head(self.max_head_size)
+            if not self.raw_head:
+                self.close_connection = 1
+                return
+            self.request_start = time.time()
+            self.parse_request()
+        except socket.timeout:
+            self.close_connection = 1
             return
-
+        except RequestError as e:
+            self.close_connection = 1
+            self.send_error(e.code)
+            return
+        self.connection.settimeout(self.timeout)
+        metrics = self.server.metrics
+        if metrics is not None:
+            started = time.time()
+            metrics.observe('parse', started - self.request_start)
+
+        self.request_count += 1
+        if self.request_count >= self.max_requests:
+            self.close_connection = 1
+
+        body = RequestBody(
+            self.rfile, self.body_length, self.body_chunked,
+            self.max_body_size,
+            self.send_continue if self.expect_continue else None
+        )
+        environ = self.get_environ()
+        if metrics is not None:
+            metrics.observe('environ', time.time() - started)
         handler = SimpleHandler(
-            self.rfile, self.wfile, sys.stderr, self.get_environ()
+            body, self.wfile, sys.stderr, environ,
+            multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess,
+            environ_ready=self.server.environ_template
         )
         handler.request_handler = self      # backpointer for logging
-        handler.run(self.server.get_app())
+        handler.metrics = metrics
+        handler.profiler = self.server.profiler
+        self.write_held()       # never wait for the next application
+        self.body = body
+        handler.run(self.get_app(environ))
+        if not self.close_connection and not body.drain(self.max_drain):
+            self.close_connection = 1
+
+    def hold_output(self, size):
+        """May 'size' bytes ending a response wait for the next request?
+
+        Only when that request was pipelined behind this one, so its head
+        can be parsed without waiting on the client.
+        """
+        return (not self.close_connection and self.body.done and
+                len(self.held_output) + size <= self.max_held_output and
+                head_complete(self.rfile.buffer))
+
+    def write_held(self):
+        if self.held_output:
+            data, self.held_output = self.held_output, ''
+            self.wfile.write(data)
+
+    def send_continue(self):
+        """Tell the client to go on sending the request body"""
+        self.write_held()
+        self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+    def get_app(self, environ):
+        """The server's application, or the metrics for their path"""
+        metrics = self.server.metrics
+        if metrics is not None and environ.get('PATH_INFO') == metrics.path:
+            return metrics
+        return self.server.get_app()
+
+    def send_error(self, code):
+        """Answer a request that never reaches the application"""
+        short, long = self.responses[code]
+        body = '%d %s\n' % (code, short)
+        self.write_held()
+        self.wfile.write(
+            'HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\n'
+            'Content-Length: %d\r\nConnection: close\r\n\r\n%s'
+            % (code, short, len(body), body)
+        )
+        if self.server.metrics is not None:
+            self.server.metrics.response(str(code), len(body))
+        self.log_request(code, len(body))
 
     def log_request(self, code='-', size='-'):
         """Log an accepted request.
         """
-        self.log_message('"%s" %s %s',
-                         self.requestline, str(code), str(size))
+        log = self.server.access_log
+        if log is None:
+            self.log_message('"%s" %s %s',
+                             self.requestline, str(code), str(size))
+            return
+        if self.request_start is None:
+            duration = 0.0
+        else:
+            duration = time.time() - self.request_start
+        log.log(remote_addr=self.client_address[0],
+                method=self.command or '-', path=self.path,
+                protocol=self.request_version, status=code, bytes=size,
+                duration=duration)
 
     def log_message(self, format, *args):
-        import datetime
-        date_time_string = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log = self.server.access_log
+        if log is not None:
+            log.message(self.client_address[0], format % args)
+            return
+        date_time_string = time.strftime("%Y-%m-%d %H:%M:%S")
         sys.stderr.write("%s - - [%s] %s\n" %
                          (self.client_address[0],
                           date_time_string,
@@ -137,14 +325,13 @@ class WSGIRequestHandler(object):
     def finish(self):
         if not self.wfile.closed:
             try:
+                self.write_held()
                 self.wfile.flush()
             except:
                 pass
         self.wfile.close()
         self.rfile.close()
 
-    MessageClass = mimetools.Message
-
     responses = {
         100: ('Continue', 'Request received, please continue'),
         101: ('Switching Protocols',
@@ -199,6 +386,8 @@ class WSGIRequestHandler(object):
               'Cannot satisfy request range.'),
         417: ('Expectation Failed',
               'Expect condition could not be satisfied.'),
+        431: ('Request Header Fields Too Large',
+              'Request headers are too large or too many.'),
 
         500: ('Internal Server Error', 'Server got itself in trouble'),
         501: ('Not Implemented',
@@ -212,6 +401,101 @@ class WSGIRequestHandler(object):
         }
 
 
+class EventRequestHandler(WSGIRequestHandler):
+    """Serve one request whose head an event loop has already buffered
+
+    'data' holds the bytes the loop read so far, starting with a complete
+    request head, and 'request_count' the number of requests served on the
+    connection before.  The connection is left open; unless
+    close_connection is set afterwards, the loop takes it back together
+    with whatever was read ahead, in 'rfile.buffer'.
+    """
+
+    # The connection goes back to the event loop after each request
+    max_held_output = 0
+
+    def __init__(self, request, client_address, server, data='',
+                 request_count=0):
+        self.data = data
+        self.request_count = request_count
+        WSGIRequestHandler.__init__(self, request, client_address, server)
+
+    def setup(self):
+        self.connection = self.request
+        self.connection.settimeout(self.timeout)
+        self.rfile = SocketReader(self.connection, self.data, self.rbufsize)
+        self.wfile = self.connection.makefile('wb', self.wbufsize)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+
+# Encoded status lines by (HTTP version, status); applications pick their
+# status strings freely, so only the first few hundred are kept.
+_status_lines = {}
+_max_status_lines = 256
+
+
+class UWSGIRequestHandler(WSGIRequestHandler):
+    """Serve a request a web server forwards with the uwsgi protocol
+
+    nginx's uwsgi_pass sends a 4-byte header, the request's CGI variables
+    as length-prefixed pairs and then the body, so there is no HTTP to
+    parse.  The response is plain HTTP, ended by closing the connection.
+    """
+
+    chunked_responses = False
+
+    def handle(self):
+        self.close_connection = 1
+        try:
+            header = self.rfile.read(uwsgi_header.size)
+            if len(header) < uwsgi_header.size:
+                return
+            self.request_start = time.time()
+            modifier1, size, modifier2 = uwsgi_header.unpack(header)
+            if modifier1 != 0:              # 0 is a WSGI request
+                raise RequestError(501, 'Unsupported modifier %d' % modifier1)
+            data = self.rfile.read(size)
+            if len(data) < size:
+                return
+            env = parse_uwsgi_vars(data)
+        except socket.timeout:
+            return
+        except RequestError as e:
+            self.send_error(e.code)
+            return
+
+        env.setdefault('SCRIPT_NAME', '')
+        env.setdefault('PATH_INFO', '')
+        self.command = env.get('REQUEST_METHOD')
+        self.path = env.get('REQUEST_URI', '-')
+        self.request_version = env.get('SERVER_PROTOCOL', '-')
+        self.requestline = '%s %s %s' % (self.command, self.path,
+                                         self.request_version)
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400)
+            return
+        if length > self.max_body_size:
+            self.send_error(413)
+            return
+
+        handler = SimpleHandler(
+            RequestBody(self.rfile, length), self.wfile, sys.stderr, env,
+            multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.metrics = self.server.metrics
+        handler.profiler = self.server.profiler
+        handler.run(self.get_app(env))
+
+
 class SimpleHandler(object):
     """Manage the invocation of a WSGI application"""
 
@@ -220,21 +504,40 @@ class SimpleHandler(object):
     wsgi_multithread = True
     wsgi_multiprocess = True
     wsgi_run_once = False
+    wsgi_file_wrapper = FileWrapper
 
+    origin_server = True    # We are transmitting direct to client
     http_version  = "1.1"   # Version that should be used for response
 
+    # The status line and headers leave in one write with the first block
+    # of the body.  Blocks yielded by an iterator are then sent as they
+    # come; those of a list or tuple, already at hand, are collected until
+    # this many bytes are pending.  0 sends every block at once.
+    output_buffer_size = 8192
+
+    server_header = 'Server: WSGIServer\r\n'
+
+    # Seconds to wait for the client to accept more of a sendfile() body
+    send_timeout = 10
+
     # os_environ is used to supply configuration from the OS environment:
     # by default it's a copy of 'os.environ' as of import time, but you can
     # override this in e.g. your __init__ method.
     os_environ = dict(os.environ.items())
 
     status = result = None
-    headers_sent = False
+    headers_sent = False    # queued by send_headers()
+    output_sent = False     # and some of the response written to stdout
     headers = None
     bytes_sent = 0
+    request_handler = None
+    metrics = None
+    profiler = None
+    chunked = False
+    trailers = None
 
     def __init__(self,stdin,stdout,stderr,environ,
-        multithread=True, multiprocess=False
+        multithread=True, multiprocess=False, environ_ready=False
     ):
         self.stdin = stdin
         self.stdout = stdout
@@ -242,22 +545,60 @@ class SimpleHandler(object):
         self.base_env = environ
         self.wsgi_multithread = multithread
         self.wsgi_multiprocess = multiprocess
+        self.environ_ready = environ_ready
+        self._pending = []
+        self._pending_size = 0
 
     def run(self, application):
         """Invoke the application"""
         try:
             self.setup_environ()
-            self.result = application(self.environ, self.start_response)
-            self.finish_response()
+            if (self.profiler is not None and
+                    self.profiler.wants(self.environ)):
+                self.profiler.profile(self.environ, self.respond, application)
+            else:
+                self.respond(application)
         except:
             self.handle_error()
         finally:
             self.close()
 
+    def respond(self, application):
+        """Call the application and send its response"""
+        if self.metrics is None:
+            self.result = application(self.environ, self.start_response)
+            self.finish_response()
+            return
+        # 'response' includes iterating over the result, which is where
+        # generator applications do their work
+        started = time.time()
+        self.result = application(self.environ, self.start_response)
+        called = time.time()
+        self.metrics.observe('app', called - started)
+        self.finish_response()
+        self.metrics.observe('response', time.time() - called)
+
     def handle_error(self):
         """Log current error, and send error output to client if possible"""
-        self.log_exception(sys.exc_info())
-        if not self.headers_sent:
+        if self.metrics is not None:
+            self.metrics.error()
+        if isinstance(sys.exc_info()[1], RequestError):
+            # A bad request body: the client's fault, and the rest of the
+            # connection can't be trusted
+            if self.request_handler is not None:
+                self.request_handler.close_connection = 1
+        else:
+            self.log_exception(sys.exc_info())
+        if self.output_sent:
+            # The response is cut short, so the connection can't be reused
+            if self.request_handler is not None:
+                self.request_handler.close_connection = 1
+        else:
+            # Nothing reached the client yet: replace what was queued
+            self._pending = []
+            self._pending_size = 0
+            self.headers_sent = self.chunked = False
+            self.bytes_sent = 0
             self.result = self.error_output(self.environ, self.start_response)
             self.finish_response()
 
@@ -267,6 +608,11 @@ class SimpleHandler(object):
         error_status = "500 Internal Server Error"
         error_headers = [('Content-Type','text/plain')]
         error_body = "A server error occurred.  Please contact the administrator."
+        exc = sys.exc_info()[1]
+        if isinstance(exc, RequestError) and self.request_handler is not None:
+            short = self.request_handler.responses[exc.code][0]
+            error_status = '%d %s' % (exc.code, short)
+            error_body = error_status + '\n'
         start_response(error_status, error_headers[:], sys.exc_info())
         return [error_body]
 
@@ -287,6 +633,14 @@ class SimpleHandler(object):
     def setup_environ(self):
         """Set up the environment for one request"""
 
+        if self.environ_ready:
+            # 'environ' is already a private copy of the server's template
+            env = self.environ = self.base_env
+            env['wsgi.input']        = self.stdin
+            env['wsgi.errors']       = self.stderr
+            env['wsgiserver.trailers'] = self.trailers = Headers([])
+            return
+
         env = self.environ = self.os_environ.copy()
         self.environ.update(self.base_env) # Add cgi env vars
 
@@ -297,16 +651,141 @@ class SimpleHandler(object):
         env['wsgi.url_scheme']   = self.get_scheme()
         env['wsgi.multithread']  = self.wsgi_multithread
         env['wsgi.multiprocess'] = self.wsgi_multiprocess
+        env['wsgi.file_wrapper'] = self.wsgi_file_wrapper
+
+        # Headers added here by the application while it produces the body
+        # are sent as trailers when the response is chunked.
+        env['wsgiserver.trailers'] = self.trailers = Headers([])
 
     def finish_response(self):
         """Send any iterable data, then close self and the iterable
         """
         try:
-            for data in self.result:
-                self.write(data)
-        finally:
+            if not self.result_is_file() or not self.send_file():
+                if type(self.result) in (ListType, TupleType):
+                    for data in self.result:
+                        self.send_data(data)
+                else:
+                    for data in self.result:
+                        self.send_data(data)
+                        self.flush()
+            self.finish_content()
+            self.end_response()
+        except:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+            raise
+        else:
             self.close()
 
+    def end_response(self):
+        """Send what is left of the response
+
+        If the request handler has the next pipelined request at hand, the
+        rest is handed to it instead, to be written once that request is
+        parsed.
+        """
+        rh = self.request_handler
+        if (rh is not None and self._pending and
+                rh.hold_output(self._pending_size)):
+            rh.held_output += ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            return
+        self.flush()
+
+    def result_is_file(self):
+        """True if the application returned a wsgi.file_wrapper"""
+        return isinstance(self.result, self.wsgi_file_wrapper)
+
+    def send_file(self):
+        """Transmit a regular file from wsgi.file_wrapper without copying
+
+        Serves a single byte Range of it with 206 when asked to.  Returns
+        False if the file can't be sent this way, leaving the result to
+        be iterated as usual.
+        """
+        filelike = self.result.filelike
+        try:
+            in_fd = filelike.fileno()
+            st = os.fstat(in_fd)
+            start = filelike.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode) or self.headers_sent:
+            return False
+        stop = st.st_size
+
+        self.headers['Accept-Ranges'] = 'bytes'
+        if ('HTTP_RANGE' in self.environ and self.status[:3] == '200' and
+                'HTTP_IF_RANGE' not in self.environ):
+            byte_range = parse_byte_range(self.environ['HTTP_RANGE'],
+                                          stop - start)
+            if byte_range is not None:
+                first, last = byte_range
+                if first >= stop - start:
+                    self.status = '416 Requested Range Not Satisfiable'
+                    self.headers['Content-Range'] = 'bytes */%d' % (stop-start)
+                    self.headers['Content-Length'] = '0'
+                    self.send_headers()
+                    return True
+                self.status = '206 Partial Content'
+                self.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    first, last - 1, stop - start)
+                start, stop = start + first, start + last
+
+        self.headers['Content-Length'] = str(stop - start)
+        self.send_headers()
+        self.flush()
+        if self.environ.get('REQUEST_METHOD') == 'HEAD':
+            return True
+        if stop > start:
+            try:
+                out_fd = self.stdout.fileno()
+            except (AttributeError, IOError, ValueError):
+                out_fd = None
+            if sendfile is not None and out_fd is not None:
+                self._sendfile(out_fd, in_fd, start, stop)
+            else:
+                self._send_mapped(in_fd, start, stop)
+        self.bytes_sent = stop - start
+        return True
+
+    def _sendfile(self, out_fd, in_fd, offset, stop):
+        while offset < stop:
+            try:
+                offset += sendfile(out_fd, in_fd, offset, stop - offset)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise
+                # the socket has a timeout, which makes it non-blocking
+                r, w, x = select.select([], [out_fd], [], self.send_timeout)
+                if not w:
+                    raise socket.timeout('timed out sending file')
+
+    def _send_mapped(self, in_fd, start, stop):
+        """Fallback: write the file region from a memory map"""
+        blksize = max(self.result.blksize, 65536)
+        data = mmap.mmap(in_fd, 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(start, stop, blksize):
+                self.stdout.write(data[offset:min(offset + blksize, stop)])
+            self.stdout.flush()
+        finally:
+            data.close()
+
+    def finish_content(self):
+        """Ensure headers are sent even if the application sent no body"""
+        if not self.headers_sent:
+            if self.has_body():
+                self.headers.setdefault('Content-Length', "0")
+            self.send_headers()
+        elif self.chunked:
+            self._write('0\r\n')
+            self._write(str(self.trailers))
+
     def get_scheme(self):
         """Return the URL scheme being used"""
         if self.environ.get("HTTPS") in ('yes','on','1'):
@@ -324,10 +803,38 @@ class SimpleHandler(object):
             if blocks==1:
                 self.headers['Content-Length'] = str(self.bytes_sent)
                 return
+        rh = self.request_handler
+        if (rh is not None and rh.chunked_responses and self.has_body() and
+                self.environ.get('SERVER_PROTOCOL', '') >= 'HTTP/1.1' and
+                self.environ.get('REQUEST_METHOD') != 'HEAD'):
+            self.headers['Transfer-Encoding'] = 'chunked'
+            self.chunked = True
+
+    def has_body(self):
+        """Return false for statuses that never carry a response body"""
+        code = self.status[:3]
+        return not (code[0] == '1' or code in ('204', '304'))
 
     def cleanup_headers(self):
         if 'Content-Length' not in self.headers:
             self.set_content_length()
+        rh = self.request_handler
+        if rh is None:
+            return
+        if ('Content-Length' not in self.headers and not self.chunked and
+                self.has_body() and
+                self.environ.get('REQUEST_METHOD') != 'HEAD'):
+            # Without a length the client can only find the end of the body
+            # by seeing the connection close.
+            rh.close_connection = 1
+        elif not rh.close_connection and \
+                not rh.body.drainable(rh.max_drain):
+            # The rest of the request body won't be read
+            rh.close_connection = 1
+        if rh.close_connection:
+            self.headers['Connection'] = 'close'
+        elif self.environ.get('SERVER_PROTOCOL') == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
 
     def start_response(self, status, headers,exc_info=None):
         """'start_response()' callable as specified by PEP 333"""
@@ -348,16 +855,29 @@ class SimpleHandler(object):
 
     def send_preamble(self):
         """Transmit version/status/date/server"""
-        self._write('HTTP/%s %s\r\n' % (self.http_version,self.status))
+        if not self.origin_server:
+            # Behind a gateway the status travels as a CGI header
+            self._write('Status: %s\r\n' % self.status)
+            return
+        key = (self.http_version, self.status)
+        line = _status_lines.get(key)
+        if line is None:
+            line = 'HTTP/%s %s\r\n' % key
+            if len(_status_lines) < _max_status_lines:
+                _status_lines[key] = line
+        self._write(line)
         if 'Date' not in self.headers:
-            self._write(
-                'Date: %s\r\n' % format_date_time(time.time())
-            )
+            self._write('Date: ' + cached_date_time() + '\r\n')
         if 'Server' not in self.headers:
-            self._write('Server: WSGIServer\r\n')
+            self._write(self.server_header)
 
     def write(self, data):
         """'write()' callable as specified by PEP 333"""
+        self.send_data(data)
+        self.flush()
+
+    def send_data(self, data):
+        """Queue a block of the response body, sending headers first"""
 
         assert type(data) is StringType,"write() argument must be string"
 
@@ -369,13 +889,35 @@ class SimpleHandler(object):
             self.send_headers()
         else:
             self.bytes_sent += len(data)
+        if self.environ.get('REQUEST_METHOD') == 'HEAD':
+            # The headers describe the body, which is not sent
+            self.bytes_sent = 0
+            return
 
         # XXX check Content-Length and truncate if too many bytes written?
-        self._write(data)
-        self.stdout.flush()
+        if self.chunked:
+            if data:
+                self._write('%x\r\n' % len(data))
+                self._write(data)
+                self._write('\r\n')
+        else:
+            self._write(data)
+        if self._pending_size >= self.output_buffer_size:
+            self.flush()
 
     def _write(self, data):
-        self.stdout.write(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+    def flush(self):
+        """Send everything queued by _write() in a single write"""
+        if self._pending:
+            data = ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            self.output_sent = True
+            self.stdout.write(data)
+        self.stdout.flush()
 
     def close(self):
         """Close the iterable (if needed) and reset all instance vars
@@ -384,13 +926,22 @@ class SimpleHandler(object):
             if hasattr(self.result, 'close'):
                 self.result.close()
         finally:
+            if self.status:
+                code = self.status.split(' ', 1)[0]
+                if self.metrics is not None:
+                    self.metrics.response(code, self.bytes_sent)
+                if self.request_handler is not None:
+                    self.request_handler.log_request(code, self.bytes_sent)
             self.result = self.headers = self.status = self.environ = None
+            self.trailers = None
             self.bytes_sent = 0
-            self.headers_sent = False
+            self.headers_sent = self.output_sent = self.chunked = False
+            self._pending = []
+            self._pending_size = 0
 
     def send_headers(self):
         """Transmit headers to the client, via self._write()"""
         self.cleanup_headers()
         self.headers_sent = True
         self.send_preamble()
-        self.stdout.write(str(self.headers))
+        self._write(str(self.headers))
@@ -1,15 +1,6 @@
 #!/usr/bin/env python
 
-from handlers import WSGIRequestHandler
-from server import WSGIServer
-
-def make_server(
-        host, port, app, server_class=WSGIServer,
-        handler_class=WSGIRequestHandler
-):
-    server = server_class((host, port), handler_class)
-    server.set_app(app)
-    server.serve_forever()
+from server import make_server
 
 
 if __name__ == "__main__":
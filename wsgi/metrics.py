@@ -0,0 +1,160 @@
+"""Counting what the server does, for Prometheus"""
+
+import os
+import bisect
+import threading
+
+__all__ = ['Metrics']
+
+# Phases of a request, in order, with their HELP text
+PHASES = (
+    ('accept', 'accept() of a connection'),
+    ('parse', 'parsing the request head'),
+    ('environ', 'building the WSGI environ'),
+    ('app', 'calling the application'),
+    ('response', 'iterating the result and sending the response'),
+)
+
+
+class _Shard(object):
+    """The counters one thread updates; only that thread writes to them"""
+
+    __slots__ = ('counters', 'buckets', 'sums')
+
+    def __init__(self, nbuckets):
+        self.counters = {}
+        self.buckets = dict((phase, [0] * nbuckets) for phase, text in PHASES)
+        self.sums = dict.fromkeys(self.buckets, 0.0)
+
+
+class Metrics(object):
+    """Request counters and per-phase latency histograms
+
+    Every thread updates a shard of its own, without locking; the shards
+    are only added up when the metrics are rendered, in the Prometheus
+    text format.  The instance is also a WSGI application serving them,
+    which the request handlers answer requests for 'path' with when it is
+    set as the server's 'metrics'.
+
+    The numbers are per process, and every sample carries the process
+    id as its 'pid' label: with PreforkWSGIServer each scrape is answered
+    by whichever worker accepts it, and the label keeps the series of
+    different workers apart, so counters don't seem to jump back and forth;
+    queries add them up with sum(...) by the other labels.
+    """
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, path='/__metrics', prefix='wsgi_'):
+        self.path = path
+        self.prefix = prefix
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = _Shard(len(self.buckets) + 1)
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def add(self, name, value=1):
+        counters = self.shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, phase, seconds):
+        """Record that a request spent 'seconds' in 'phase'"""
+        shard = self.shard()
+        shard.buckets[phase][bisect.bisect_left(self.buckets, seconds)] += 1
+        shard.sums[phase] += seconds
+
+    def connection_opened(self):
+        self.add('connections_active', 1)
+        self.add('connections_total', 1)
+
+    def connection_closed(self):
+        self.add('connections_active', -1)
+
+    def response(self, status, size):
+        """Count a response with the status code 'status'"""
+        counters = self.shard().counters
+        key = ('responses_total', status)
+        counters[key] = counters.get(key, 0) + 1
+        counters['bytes_sent_total'] = \
+            counters.get('bytes_sent_total', 0) + size
+
+    def error(self):
+        self.add('errors_total', 1)
+
+    def collect(self):
+        """Add up the shards: (counters, bucket counts, sums)"""
+        with self.lock:
+            shards = list(self.shards)
+        counters = {}
+        buckets = dict((phase, [0] * (len(self.buckets) + 1))
+                       for phase, text in PHASES)
+        sums = dict.fromkeys(buckets, 0.0)
+        for shard in shards:
+            for name, value in shard.counters.items():
+                counters[name] = counters.get(name, 0) + value
+            for phase, counts in shard.buckets.items():
+                total = buckets[phase]
+                for i, n in enumerate(counts):
+                    total[i] += n
+                sums[phase] += shard.sums[phase]
+        return counters, buckets, sums
+
+    def render(self):
+        counters, buckets, sums = self.collect()
+        p = self.prefix
+        pid = 'pid="%d"' % os.getpid()
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP %s%s %s' % (p, name, text))
+            lines.append('# TYPE %s%s %s' % (p, name, kind))
+            for labels, value in samples:
+                lines.append('%s%s{%s} %s' % (p, name, labels + pid, value))
+
+        metric('connections_active', 'gauge', 'Open client connections.',
+               [('', counters.get('connections_active', 0))])
+        metric('connections_total', 'counter', 'Accepted client connections.',
+               [('', counters.get('connections_total', 0))])
+        codes = sorted(key[1] for key in counters if type(key) is tuple)
+        metric('responses_total', 'counter', 'Responses by status code.',
+               [('code="%s",' % code, counters[('responses_total', code)])
+                for code in codes])
+        metric('bytes_sent_total', 'counter', 'Response body bytes sent.',
+               [('', counters.get('bytes_sent_total', 0))])
+        metric('errors_total', 'counter', 'Exceptions raised by applications.',
+               [('', counters.get('errors_total', 0))])
+
+        lines.append('# HELP %sphase_seconds Time spent in each phase of a '
+                     'request.' % p)
+        lines.append('# TYPE %sphase_seconds histogram' % p)
+        for phase, text in PHASES:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), buckets[phase]):
+                cumulative += n
+                lines.append('%sphase_seconds_bucket{phase="%s",le="%s",%s} %d'
+                             % (p, phase, bound, pid, cumulative))
+            lines.append('%sphase_seconds_sum{phase="%s",%s} %r'
+                         % (p, phase, pid, sums[phase]))
+            lines.append('%sphase_seconds_count{phase="%s",%s} %d'
+                         % (p, phase, pid, cumulative))
+        metric('process_id', 'gauge', 'Process reporting these metrics.',
+               [('', os.getpid())])
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        body = self.render()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-cache'),
+        ])
+        return [body]
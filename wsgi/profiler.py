@@ -0,0 +1,160 @@
+"""Profiling a sample of the requests an application serves"""
+
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+
+__all__ = ['Profiler']
+
+
+def route_name(environ):
+    """Default route key: PATH_INFO made into a file name"""
+    path = environ.get('PATH_INFO', '').strip('/')
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', path)[:100].strip('.') or 'index'
+
+
+class Profiler(object):
+    """Profile one request in 'every', or those asking for it, per route
+
+    A request is profiled when it is the 'every'-th since the last one
+    (never if 'every' is 0), or when it carries the 'header' request
+    header with the value 'token'; without a token the header is ignored,
+    so clients can't make the server profile whatever they like.
+    Profiles are added up per route, as named by route(environ), and
+    written to 'directory':
+
+    - mode 'cprofile' runs the request under cProfile and keeps
+      <route>.prof, for pstats or snakeviz;
+    - mode 'sample' has a thread look at the request's stack every
+      'interval' seconds instead, which costs the request next to
+      nothing, and keeps <route>.collapsed in the folded format of
+      flamegraph.pl.
+
+    Set it as the server's 'profiler' to use it.  At most 'max_routes'
+    routes get files of their own; the rest share 'other'.  Under a
+    multi-process server each process writes <route>.<pid> files.
+    """
+
+    def __init__(self, directory, every=100, header='X-Profile', token=None,
+                 mode='cprofile', interval=0.005, route=route_name,
+                 max_routes=100):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError("mode must be 'cprofile' or 'sample'")
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.every = every
+        self.header = 'HTTP_' + header.upper().replace('-', '_')
+        self.token = token
+        self.mode = mode
+        self.interval = interval
+        self.route = route
+        self.max_routes = max_routes
+        self.counter = itertools.count(1)
+        self.stats = {}         # route -> pstats.Stats or {stack: count}
+        self.lock = threading.Lock()
+        self.active = {}        # thread id -> route, in sample mode
+        self.sampler = None
+        self.sampler_pid = None
+
+    def wants(self, environ):
+        """Should this request be profiled?"""
+        if self.token is not None and \
+                environ.get(self.header) == self.token:
+            return True
+        return bool(self.every) and next(self.counter) % self.every == 0
+
+    def profile(self, environ, func, *args):
+        """Call func(*args) for the request in 'environ', profiling it"""
+        route = self.route(environ)
+        with self.lock:
+            if route not in self.stats and len(self.stats) >= self.max_routes:
+                route = 'other'
+        # Worker processes each keep their own files
+        if environ.get('wsgi.multiprocess'):
+            filename = '%s.%d' % (route, os.getpid())
+        else:
+            filename = route
+        if self.mode == 'sample':
+            return self.sample(route, filename, func, *args)
+
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            with self.lock:
+                stats = self.stats.get(route)
+                if stats is None:
+                    stats = self.stats[route] = pstats.Stats(prof)
+                else:
+                    stats.add(prof)
+                self.write(filename + '.prof', stats.dump_stats)
+
+    def sample(self, route, filename, func, *args):
+        if self.sampler_pid != os.getpid():
+            self.start_sampler()
+        ident = threading.current_thread().ident
+        self.active[ident] = route
+        try:
+            return func(*args)
+        finally:
+            del self.active[ident]
+            with self.lock:
+                stacks = self.stats.get(route, {})
+                lines = ['%s %d\n' % item for item in stacks.items()]
+
+            def dump(name):
+                with open(name, 'w') as f:
+                    f.writelines(lines)
+            self.write(filename + '.collapsed', dump)
+
+    def start_sampler(self):
+        with self.lock:
+            if self.sampler_pid == os.getpid():
+                return
+            self.active = {}
+            self.sampler = threading.Thread(target=self.run_sampler,
+                                            name='profile-sampler')
+            self.sampler.daemon = True
+            self.sampler.start()
+            self.sampler_pid = os.getpid()
+
+    def run_sampler(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            samples = []
+            for ident, route in self.active.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.reverse()
+                    samples.append((route, ';'.join(stack)))
+            frames = None
+            with self.lock:
+                for route, key in samples:
+                    stacks = self.stats.setdefault(route, {})
+                    stacks[key] = stacks.get(key, 0) + 1
+
+    def write(self, name, dump):
+        """Replace 'name' in the directory with what dump(filename) writes"""
+        filename = os.path.join(self.directory, name)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            dump(tmp)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,435 @@
+"""Reading HTTP requests from client connections"""
+
+import socket
+import errno
+import struct
+
+__all__ = ['SocketReader', 'RequestBody', 'RequestError', 'head_complete',
+           'parse_head', 'parse_uwsgi_vars']
+
+
+class RequestError(Exception):
+    """The request can't be served; 'code' is the HTTP status to answer"""
+
+    def __init__(self, code, message=''):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+def find_head_end(data, start=0):
+    """Return (end of the request head, length of the blank line)
+
+    Returns (-1, 0) if 'data' doesn't hold a complete head yet.  Bare LF
+    line ends are accepted as well as CRLF.
+    """
+    i = data.find('\r\n\r\n', start)
+    j = data.find('\n\n', start)
+    if i >= 0 and (j < 0 or i < j):
+        return i, 4
+    if j >= 0:
+        return j, 2
+    return -1, 0
+
+
+def head_complete(data):
+    """Return true if 'data' holds a complete request line and headers"""
+    return find_head_end(data.lstrip('\r\n'))[0] >= 0
+
+
+# CGI names for the headers most requests carry, so they skip the
+# replace/upper; anything else goes through _cgi_name().
+_header_keys = {}
+for _name in (
+        'Host', 'User-Agent', 'Accept', 'Accept-Encoding', 'Accept-Language',
+        'Accept-Charset', 'Connection', 'Keep-Alive', 'Cookie', 'Referer',
+        'Origin', 'Cache-Control', 'Pragma', 'Authorization', 'Expect',
+        'If-None-Match', 'If-Modified-Since', 'Range', 'Transfer-Encoding',
+        'Upgrade-Insecure-Requests', 'X-Forwarded-For', 'X-Forwarded-Proto',
+        'X-Real-IP', 'X-Requested-With'):
+    _header_keys[_name] = _header_keys[_name.lower()] = \
+        'HTTP_' + _name.upper().replace('-', '_')
+for _name in ('Content-Type', 'Content-Length'):
+    _header_keys[_name] = _header_keys[_name.lower()] = \
+        _name.upper().replace('-', '_')
+del _name
+
+
+def _cgi_name(name):
+    key = 'HTTP_' + name.upper().replace('-', '_')
+    if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+        key = key[5:]
+    return key
+
+
+def parse_head(head, max_headers=100):
+    """Split a request head into its request line and CGI header variables
+
+    The header dictionary maps CGI names ('HTTP_HOST', 'CONTENT_TYPE'...)
+    to values; repeated headers are joined with commas.  Headers whose
+    names contain '_' are dropped, since their CGI names would clash with
+    those of real headers (Content_Length with Content-Length) that a
+    proxy in front treats differently.  Raises RequestError for malformed
+    heads or more than 'max_headers' headers.
+    """
+    lines = head.splitlines()
+    if len(lines) > max_headers + 1:
+        raise RequestError(431, 'Too many headers')
+    headers = {}
+    key = None
+    for line in lines[1:]:
+        if line[:1] in (' ', '\t'):
+            # obsolete line folding continues the previous header
+            if key is None:
+                raise RequestError(400, 'Bad header continuation')
+            if key:
+                headers[key] += ' ' + line.strip()
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name or name[-1:] in (' ', '\t'):
+            raise RequestError(400, 'Bad header line %r' % line)
+        key = _header_keys.get(name)
+        if key is None:
+            if '_' in name:
+                key = ''            # dropped, with its continuation lines
+                continue
+            key = _cgi_name(name)
+        value = value.strip()
+        if key in headers:
+            headers[key] += ',' + value
+        else:
+            headers[key] = value
+    return lines[0], headers
+
+
+# uwsgi packet header: modifier1, size of the vars block, modifier2
+uwsgi_header = struct.Struct('<BHB')
+
+def parse_uwsgi_vars(data):
+    """Decode the vars block of a uwsgi packet into a dictionary
+
+    Each key and value is preceded by its length as a 16-bit little
+    endian integer.
+    """
+    env = {}
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            size, = struct.unpack_from('<H', data, pos)
+            key = data[pos + 2:pos + 2 + size]
+            pos += 2 + size
+            size, = struct.unpack_from('<H', data, pos)
+            env[key] = data[pos + 2:pos + 2 + size]
+            pos += 2 + size
+    except struct.error:
+        raise RequestError(400, 'Truncated uwsgi vars')
+    return env
+
+
+class SocketReader(object):
+    """Buffered, file-like reader over a socket
+
+    Works like socket.makefile('rb'), except that the bytes read ahead of
+    what the caller consumed stay visible in 'buffer', so an event loop can
+    hand a connection back and forth without losing data.
+    """
+
+    bufsize = 8192
+
+    def __init__(self, sock, data='', bufsize=None):
+        self.sock = sock
+        self.buffer = data
+        if bufsize is not None and bufsize > 0:
+            self.bufsize = bufsize
+        self.closed = False
+
+    def fill(self):
+        """Read once from the socket into the buffer; return the new data"""
+        while True:
+            try:
+                data = self.sock.recv(self.bufsize)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.buffer += data
+            return data
+
+    def read_head(self, limit=65536):
+        """Consume the next request head and return it
+
+        The blank line ending the head is dropped, as are empty lines
+        before the request line.  Returns '' if the connection closes
+        first; raises RequestError if the head exceeds 'limit' bytes.
+        """
+        start = 0
+        while True:
+            if self.buffer[:1] in ('\r', '\n'):
+                self.buffer = self.buffer.lstrip('\r\n')
+                start = 0
+            end, blank = find_head_end(self.buffer, start)
+            if end >= 0:
+                head = self.buffer[:end]
+                self.buffer = self.buffer[end + blank:]
+                return head
+            if len(self.buffer) > limit:
+                raise RequestError(431, 'Request head too large')
+            start = max(0, len(self.buffer) - 3)
+            if not self.fill():
+                return ''
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.buffer]
+            self.buffer = ''
+            while self.fill():
+                chunks.append(self.buffer)
+                self.buffer = ''
+            return ''.join(chunks)
+
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        if len(data) == size:
+            return data
+        chunks = [data]
+        left = size - len(data)
+        while left > 0 and self.fill():
+            data = self.buffer[:left]
+            self.buffer = self.buffer[left:]
+            chunks.append(data)
+            left -= len(data)
+        return ''.join(chunks)
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            i = self.buffer.find('\n', start)
+            if i >= 0:
+                end = i + 1
+                break
+            if 0 <= size <= len(self.buffer):
+                end = size
+                break
+            start = len(self.buffer)
+            if not self.fill():
+                end = len(self.buffer)
+                break
+        if 0 <= size < end:
+            end = size
+        line = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        return line
+
+    def readinto(self, b):
+        """Read at most len(b) bytes into the writable buffer 'b'
+
+        Buffered bytes are copied first; otherwise the socket receives
+        straight into 'b'.  Returns the number of bytes, 0 at the end.
+        """
+        if self.buffer:
+            n = min(len(b), len(self.buffer))
+            b[:n] = self.buffer[:n]
+            self.buffer = self.buffer[n:]
+            return n
+        while True:
+            try:
+                return self.sock.recv_into(b)
+            except socket.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        # The socket belongs to the request handler; keep the buffer too,
+        # it may hold the start of the next request.
+        self.closed = True
+
+
+class RequestBody(object):
+    """File-like wsgi.input holding the request body and nothing more
+
+    Reading stops at the end of the body given by 'length', or at the last
+    chunk of a chunked body, so an application can neither read into the
+    next request nor wait for bytes the client never sends.  A chunked body
+    growing past 'max_size' raises RequestError(413).  'send_continue' is
+    called before the body is first read, for clients that sent
+    "Expect: 100-continue".
+    """
+
+    max_trailers = 100
+
+    def __init__(self, rfile, length=0, chunked=False, max_size=None,
+                 send_continue=None):
+        self.rfile = rfile
+        self.left = length      # bytes left of the body, or current chunk
+        self.chunked = chunked
+        self.max_size = max_size
+        self.send_continue = send_continue
+        self.received = 0
+        self.in_chunk = False
+        self.done = not chunked and length <= 0
+        self.failed = False
+
+    def _ready(self):
+        """Return how many bytes can be read before the next chunk header"""
+        if not self.left and self.done:
+            return 0
+        if self.send_continue is not None:
+            send_continue, self.send_continue = self.send_continue, None
+            send_continue()
+        if not self.left and self.chunked:
+            try:
+                self._next_chunk()
+            except:
+                self.left = 0
+                self.done = self.failed = True
+                raise
+        return self.left
+
+    def _next_chunk(self):
+        if self.in_chunk:
+            if self.rfile.readline(2) not in ('\r\n', '\n'):
+                raise RequestError(400, 'Missing CRLF after chunk')
+            self.in_chunk = False
+        line = self.rfile.readline(1024)
+        if not line.endswith('\n'):
+            raise RequestError(400, 'Bad chunk size line')
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestError(400, 'Bad chunk size %r' % line)
+        if size < 0:
+            raise RequestError(400, 'Bad chunk size %r' % line)
+        if size == 0:
+            # Trailers are read and ignored, up to the closing blank line
+            for i in xrange(self.max_trailers + 1):
+                line = self.rfile.readline(8192)
+                if not line.endswith('\n'):
+                    raise RequestError(400, 'Bad trailer')
+                if not line.strip():
+                    self.done = True
+                    return
+            raise RequestError(431, 'Too many trailers')
+        self.received += size
+        if self.max_size is not None and self.received > self.max_size:
+            raise RequestError(413, 'Request body too large')
+        self.left = size
+        self.in_chunk = True
+
+    def _consumed(self, n, complete):
+        self.left -= n
+        if not complete:
+            # the client closed the connection in the middle of the body
+            self.left = 0
+            self.done = self.failed = True
+        elif not self.left and not self.chunked:
+            self.done = True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while size != 0:
+            n = self._ready()
+            if not n:
+                break
+            if size > 0:
+                n = min(n, size)
+                size -= n
+            data = self.rfile.read(n)
+            self._consumed(len(data), len(data) == n)
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        chunks = []
+        while size != 0:
+            n = self._ready()
+            if not n:
+                break
+            if size > 0:
+                n = min(n, size)
+            line = self.rfile.readline(n)
+            self._consumed(len(line), len(line) == n or line.endswith('\n'))
+            chunks.append(line)
+            if line.endswith('\n'):
+                break
+            if size > 0:
+                size -= len(line)
+        return ''.join(chunks)
+
+    def readlines(self, hint=None):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
+
+    def readinto(self, b):
+        """Read at most len(b) bytes of the body into the buffer 'b'"""
+        view = memoryview(b)
+        n = self._ready()
+        if not n or not len(view):
+            return 0
+        if len(view) > n:
+            view = view[:n]
+        got = self.rfile.readinto(view)
+        self._consumed(got, got > 0)
+        return got
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def drainable(self, limit=65536):
+        """Return False if drain(limit) is bound to fail
+
+        The rest of a chunked body is not known in advance, so drain() may
+        fail even when this returns True.
+        """
+        if self.failed:
+            return False
+        if self.done:
+            return True
+        if self.send_continue is not None:
+            return False
+        return self.left <= limit
+
+    def drain(self, limit=65536):
+        """Discard what the application left of the body
+
+        Returns True if the next request can be read from the connection,
+        False if the body was bad, cut short, never asked for with
+        "100 Continue" or more than 'limit' bytes were left.
+        """
+        if self.failed:
+            return False
+        if self.done:
+            return True
+        if self.send_continue is not None:
+            return False
+        try:
+            while True:
+                n = self._ready()
+                if not n:
+                    return not self.failed
+                if n > limit:
+                    return False
+                data = self.rfile.read(n)
+                self._consumed(len(data), len(data) == n)
+                limit -= len(data)
+        except (RequestError, socket.error):
+            return False
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
 import sys
+import os
+import time
+import signal
 import socket
 import select
 import errno
-from handlers import WSGIRequestHandler
+import threading
+import Queue
+from handlers import WSGIRequestHandler, EventRequestHandler, SimpleHandler
+from handlers import UWSGIRequestHandler
+from protocol import head_complete, find_head_end
+from util import HostnameCache
 
 DEFAULT_ERROR_MESSAGE = """\
 <head>
@@ -34,45 +42,134 @@ class WSGIServer(object):
     socket_type = socket.SOCK_STREAM
     request_queue_size = 5
 
+    # Advertised to applications as wsgi.multithread/wsgi.multiprocess
+    multithread = False
+    multiprocess = False
+
+    # Reverse DNS is opt-in: REMOTE_HOST is then filled from a cache that
+    # is resolved in the background, and SERVER_NAME is the FQDN.
+    resolve_hostnames = False
+
+    # With environ_template set, base_environ is built once as the whole
+    # per-request environ minus the request's own keys: the CGI server
+    # variables, the wsgi.* constants and only the OS variables named in
+    # os_environ_keys.  Requests then cost a single dict copy.
+    environ_template = False
+    os_environ_keys = ()
+
+    # An accesslog.AccessLog writing the request log from a background
+    # thread; without one, log lines are written to stderr as they come.
+    access_log = None
+
+    # A metrics.Metrics counting connections, requests and the time spent
+    # in each phase of them; its path then serves the numbers.
+    metrics = None
+
+    # A profiler.Profiler running a sample of the requests under a profiler
+    profiler = None
+
     application = None
-    __shutdown_request = False
+    _shutdown_request = False
 
     def __init__(self, server_address, RequestHandlerClass):
         self.server_address = server_address
         self.RequestHandlerClass = RequestHandlerClass
+        if self.resolve_hostnames:
+            self.hostnames = HostnameCache()
         self.socket = socket.socket(self.address_family, self.socket_type)
         try:
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind(self.server_address)
-            host, port = self.socket.getsockname()[:2]
-            self.server_name = socket.getfqdn(host)
-            self.server_port = port
-            self.server_address = self.socket.getsockname()
+            self.server_bind()
             self.setup_environ()
-            self.socket.listen(self.request_queue_size)
+            self.server_activate()
         except:
             self.socket.close()
             raise
 
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        host, port = self.socket.getsockname()[:2]
+        if self.resolve_hostnames:
+            self.server_name = socket.getfqdn(host)
+        elif host in ('', '0.0.0.0', '::'):
+            self.server_name = socket.gethostname()
+        else:
+            self.server_name = host
+        self.server_port = port
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+
     def fileno(self):
         return self.socket.fileno()
 
     def serve_forever(self, poll_interval=0.5):
         try:
-            while not self.__shutdown_request:
+            while not self._shutdown_request:
                 r, w, e = _eintr_retry(select.select, [self], [], [], poll_interval)
                 if self in r:
                     self.handle_request_noblock()
         finally:
-            self.socket.close()
+            self.server_close()
+
+    def server_close(self):
+        """Clean up once serving stopped and no request is in progress"""
+        self.socket.close()
+        if self.access_log is not None:
+            self.access_log.close()     # lines logged by the last requests
+
+    def requests_waiting(self):
+        """Are clients waiting to be accepted?"""
+        try:
+            r, w, x = select.select([self.socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return bool(r)
+
+    def shutdown(self):
+        """Stop serve_forever() after the current poll interval"""
+        self._shutdown_request = True
+
+    def get_request(self):
+        """Accept a connection, timing it when metrics are kept"""
+        metrics = self.metrics
+        if metrics is None:
+            return self.socket.accept()
+        started = time.time()
+        request = self.socket.accept()
+        metrics.observe('accept', time.time() - started)
+        metrics.connection_opened()
+        return request
 
     def handle_request_noblock(self):
         try:
-            request, client_address = self.socket.accept()
+            request, client_address = self.get_request()
         except socket.error:
             return
-        self.RequestHandlerClass(request, client_address, self)
-        request.close()
+        self.process_request(request, client_address)
+
+    def process_request(self, request, client_address):
+        try:
+            self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        if self.metrics is not None:
+            self.metrics.connection_closed()
+        try:
+            request.close()
+        except socket.error:
+            pass
+
+    def handle_error(self, request, client_address):
+        import traceback
+        sys.stderr.write('Exception happened during processing of request '
+                         'from %s\n' % (client_address,))
+        traceback.print_exc()
 
     def setup_environ(self):
         env = self.base_environ = {}
@@ -82,6 +179,16 @@ class WSGIServer(object):
         env['REMOTE_HOST']=''
         env['CONTENT_LENGTH']=''
         env['SCRIPT_NAME'] = ''
+        if self.environ_template:
+            for key in self.os_environ_keys:
+                if key in os.environ:
+                    env.setdefault(key, os.environ[key])
+            env['wsgi.version'] = SimpleHandler.wsgi_version
+            env['wsgi.run_once'] = SimpleHandler.wsgi_run_once
+            env['wsgi.url_scheme'] = 'http'
+            env['wsgi.multithread'] = self.multithread
+            env['wsgi.multiprocess'] = self.multiprocess
+            env['wsgi.file_wrapper'] = SimpleHandler.wsgi_file_wrapper
 
     def get_app(self):
         return self.application
@@ -90,11 +197,467 @@ class WSGIServer(object):
         self.application = application
 
 
+class ThreadPoolWSGIServer(WSGIServer):
+    """Hand accepted connections to a fixed pool of worker threads
+
+    Connections wait in a queue of at most 'queue_size' entries; once it
+    is full the accept loop blocks, so further clients wait in the
+    kernel's listen backlog instead of piling up in memory.
+    """
+
+    multithread = True
+
+    workers = 10
+    queue_size = 64
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 workers=None, queue_size=None):
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+        self.requests = Queue.Queue(self.queue_size)
+        self.threads = []
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def server_close(self):
+        self.stop_workers()
+        WSGIServer.server_close(self)
+
+    def start_workers(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_request_thread,
+                                 name='wsgi-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop_workers(self):
+        """Let the workers finish queued connections, then stop them"""
+        for t in self.threads:
+            self.requests.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def handle_request_noblock(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        self.requests.put((request, client_address))
+
+    def requests_waiting(self):
+        # Connections are accepted as they come, and wait in the queue
+        return not self.requests.empty()
+
+    def process_request_thread(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            self.process_request(*item)
+
+
+class _Connection(object):
+    """A client connection waiting in EpollWSGIServer's loop"""
+
+    __slots__ = ('sock', 'client_address', 'data', 'scanned',
+                 'request_count', 'last_active')
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.data = ''
+        self.scanned = 0        # bytes of data searched for the head's end
+        self.request_count = 0
+        self.last_active = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class EpollWSGIServer(WSGIServer):
+    """Multiplex all client connections on one edge-triggered epoll loop
+
+    Connections are read without blocking until a complete request head
+    is buffered; only then is the request handed to RequestHandlerClass,
+    which must be an EventRequestHandler.  Kept-alive connections go back
+    into the loop afterwards, so an idle client costs a dict entry rather
+    than a thread.  Connections idle for 'idle_timeout' seconds or sending
+    a head larger than 'max_head_size' are closed.
+    """
+
+    request_queue_size = 128
+
+    idle_timeout = 5
+    max_head_size = 65536
+
+    def __init__(self, server_address,
+                 RequestHandlerClass=EventRequestHandler):
+        self.connections = {}
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        self.socket.setblocking(0)
+        self.epoll = select.epoll()
+        self.epoll.register(self.fileno(), select.EPOLLIN | select.EPOLLET)
+
+    def serve_forever(self, poll_interval=0.5):
+        last_sweep = time.time()
+        try:
+            while not self._shutdown_request:
+                try:
+                    events = self.epoll.poll(poll_interval)
+                except IOError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                for fd, event in events:
+                    if fd == self.fileno():
+                        self.accept_connections()
+                    elif fd in self.connections:
+                        self.read_connection(self.connections[fd])
+                if time.time() - last_sweep >= poll_interval:
+                    last_sweep = time.time()
+                    self.close_idle_connections()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        for conn in self.connections.values():
+            self.close_connection(conn)
+        self.epoll.close()
+        WSGIServer.server_close(self)
+
+    def accept_connections(self):
+        # Edge-triggered: keep accepting until the backlog is empty
+        while True:
+            try:
+                sock, client_address = self.get_request()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            self.watch(_Connection(sock, client_address))
+
+    def watch(self, conn):
+        conn.scanned = 0
+        self.connections[conn.fileno()] = conn
+        self.epoll.register(conn.fileno(), select.EPOLLIN | select.EPOLLET)
+
+    def unwatch(self, conn):
+        self.epoll.unregister(conn.fileno())
+        del self.connections[conn.fileno()]
+
+    def close_connection(self, conn):
+        if conn.fileno() in self.connections:
+            self.unwatch(conn)
+        self.shutdown_request(conn.sock)
+
+    def read_connection(self, conn):
+        while True:
+            try:
+                data = conn.sock.recv(8192)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close_connection(conn)
+                return
+            if not data:
+                self.close_connection(conn)
+                return
+            conn.data += data
+            if conn.data[:1] in ('\r', '\n'):
+                conn.data = conn.data.lstrip('\r\n')
+                conn.scanned = 0
+            # Only the new data can complete the head
+            if find_head_end(conn.data, max(0, conn.scanned - 3))[0] >= 0:
+                # The handler reads the rest; adding the connection back
+                # to the epoll set reports any data left unread.
+                conn.last_active = time.time()
+                self.unwatch(conn)
+                self.process_connection(conn)
+                return
+            conn.scanned = len(conn.data)
+            if conn.scanned > self.max_head_size:
+                self.close_connection(conn)
+                return
+        conn.last_active = time.time()
+
+    def process_connection(self, conn):
+        """Serve buffered requests, then return the connection to the loop"""
+        while True:
+            conn.sock.setblocking(1)
+            try:
+                handler = self.RequestHandlerClass(
+                    conn.sock, conn.client_address, self,
+                    conn.data, conn.request_count
+                )
+            except Exception:
+                self.handle_error(conn.sock, conn.client_address)
+                self.shutdown_request(conn.sock)
+                return
+            if handler.close_connection:
+                self.shutdown_request(conn.sock)
+                return
+            conn.data = handler.rfile.buffer
+            conn.request_count = handler.request_count
+            if not head_complete(conn.data):
+                break
+        conn.sock.setblocking(0)
+        conn.last_active = time.time()
+        self.watch(conn)
+
+    def close_idle_connections(self):
+        deadline = time.time() - self.idle_timeout
+        for conn in self.connections.values():
+            if conn.last_active < deadline:
+                self.close_connection(conn)
+
+
+class AsyncWSGIServer(EpollWSGIServer):
+    """EpollWSGIServer that runs requests on a pool of executor threads
+
+    The loop thread only accepts connections and collects request heads;
+    each complete request is queued for one of 'workers' threads, which
+    runs the application and puts the connection back into the loop.  A
+    slow application or slow request body therefore never stalls the
+    other connections, and existing WSGI applications run unchanged.
+    """
+
+    multithread = True
+
+    workers = 10
+
+    def __init__(self, server_address,
+                 RequestHandlerClass=EventRequestHandler, workers=None):
+        if workers is not None:
+            self.workers = workers
+        self.tasks = Queue.Queue()
+        self.threads = []
+        EpollWSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+    def serve_forever(self, poll_interval=0.5):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_connection_thread,
+                                 name='wsgi-executor-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        EpollWSGIServer.serve_forever(self, poll_interval)
+
+    def server_close(self):
+        # Requests in progress still hand their connection back to the loop
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        EpollWSGIServer.server_close(self)
+
+    def process_connection(self, conn):
+        self.tasks.put(conn)
+
+    def process_connection_thread(self):
+        while True:
+            conn = self.tasks.get()
+            if conn is None:
+                break
+            EpollWSGIServer.process_connection(self, conn)
+
+
+class UWSGIServer(WSGIServer):
+    """WSGIServer taking requests from a web server's uwsgi_pass"""
+
+    def __init__(self, server_address,
+                 RequestHandlerClass=UWSGIRequestHandler):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+
+# Python 2 doesn't export the constant; this is its value on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class PreforkWSGIServer(WSGIServer):
+    """Serve from a set of forked worker processes
+
+    The master binds the address and forks 'workers' processes that each
+    run the plain serve_forever() loop, replacing any worker that dies.
+    With 'reuse_port' every worker listens on its own SO_REUSEPORT socket
+    so the kernel spreads connections between them; otherwise they share
+    the master's listening socket.
+
+    Signals to the master: SIGTERM/SIGINT stop gracefully, letting workers
+    finish the request in hand for up to 'graceful_timeout' seconds, and
+    SIGHUP replaces the workers one at a time.
+    """
+
+    multiprocess = True
+
+    workers = 4
+    reuse_port = False
+    graceful_timeout = 30
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 workers=None, reuse_port=None):
+        if workers is not None:
+            self.workers = workers
+        if reuse_port is not None:
+            self.reuse_port = reuse_port
+        self.children = set()
+        self._stopping = self._reloading = False
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+    def server_activate(self):
+        # With SO_REUSEPORT the master only holds the port; a listening
+        # socket nobody accepts on would still be handed connections.
+        if not self.reuse_port:
+            WSGIServer.server_activate(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        try:
+            while not self._stopping:
+                self.reap_workers()
+                if self._reloading:
+                    self._reloading = False
+                    self.reload_workers()
+                while len(self.children) < self.workers and not self._stopping:
+                    self.spawn_worker()
+                time.sleep(poll_interval)
+        finally:
+            self.stop_workers()
+            self.socket.close()
+
+    def handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        status = 0
+        try:
+            self.children = set()
+            self.init_worker()
+            WSGIServer.serve_forever(self)
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def init_worker(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.reuse_port:
+            self.socket.close()
+            self.socket = socket.socket(self.address_family, self.socket_type)
+            self.server_bind()
+            WSGIServer.server_activate(self)
+        # Several workers wake up for each connection on a shared socket;
+        # the losers must not block in accept().
+        self.socket.setblocking(0)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            if pid in self.children:
+                self.children.discard(pid)
+                if not self._stopping:
+                    sys.stderr.write('worker %d exited with status %d\n'
+                                     % (pid, status))
+
+    def reload_workers(self):
+        """Replace each worker by a fresh one, one at a time"""
+        for pid in list(self.children):
+            self.spawn_worker()
+            self.stop_worker(pid)
+
+    def stop_worker(self, pid):
+        self.kill_worker(pid, signal.SIGTERM)
+        if not self.wait_workers([pid], self.graceful_timeout):
+            self.kill_worker(pid, signal.SIGKILL)
+            self.wait_workers([pid], None)
+
+    def stop_workers(self):
+        pids = list(self.children)
+        for pid in pids:
+            self.kill_worker(pid, signal.SIGTERM)
+        if not self.wait_workers(pids, self.graceful_timeout):
+            for pid in list(self.children):
+                self.kill_worker(pid, signal.SIGKILL)
+            self.wait_workers(pids, None)
+
+    def kill_worker(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def wait_workers(self, pids, timeout):
+        """Wait until the given workers exited; False on timeout"""
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            self.reap_workers()
+            if not self.children.intersection(pids):
+                return True
+            if deadline and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+
 def make_server(
         host, port, app, server_class=WSGIServer,
-        handler_class=WSGIRequestHandler
+        handler_class=WSGIRequestHandler, workers=None, processes=None,
+        access_log=None, metrics=None, profiler=None
 ):
-    server = server_class((host, port), handler_class)
+    if processes:
+        server = PreforkWSGIServer((host, port), handler_class, processes)
+    elif workers:
+        server = ThreadPoolWSGIServer((host, port), handler_class, workers)
+    else:
+        server = server_class((host, port), handler_class)
+    if access_log is not None:
+        server.access_log = access_log
+    if metrics is not None:
+        server.metrics = metrics
+    if profiler is not None:
+        server.profiler = profiler
     server.set_app(app)
     server.serve_forever()
 
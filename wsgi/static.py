@@ -0,0 +1,176 @@
+"""Serving static files from a directory"""
+
+import os
+import stat
+import mimetypes
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from util import FileWrapper, format_date_time
+
+__all__ = ['StaticFiles']
+
+
+class _Entry(object):
+    """What is known about one file, and its bytes if small enough"""
+
+    __slots__ = ('mtime', 'size', 'etag', 'headers', 'data')
+
+    def __init__(self, filename, st, data=None):
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        content_type = mimetypes.guess_type(filename)[0]
+        self.headers = [
+            ('Content-Type', content_type or 'application/octet-stream'),
+            ('ETag', self.etag),
+            ('Last-Modified', format_date_time(st.st_mtime)),
+        ]
+        self.data = data
+
+    def is_current(self, st):
+        return self.mtime == st.st_mtime and self.size == st.st_size
+
+
+class StaticFiles(object):
+    """WSGI application serving the files under 'root' at URL 'prefix'
+
+    Files of at most 'max_file_size' bytes are kept in memory, together
+    with their ETag and Last-Modified headers, until 'max_cache_size'
+    bytes are cached; the least recently used go first.  A cached file is
+    reloaded when its mtime or size changes.  Larger files are handed to
+    wsgi.file_wrapper so the server can send them with sendfile().
+
+    Conditional requests are answered with 304 Not Modified.  Requests
+    outside 'prefix' are passed to 'app', or get 404 without one.
+    """
+
+    index = 'index.html'
+
+    def __init__(self, root, prefix='/static/', app=None,
+                 max_cache_size=16 << 20, max_file_size=256 << 10):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        self.app = app
+        self.max_cache_size = max_cache_size
+        self.max_file_size = max_file_size
+        self.cache = OrderedDict()      # filename -> _Entry
+        self.cache_size = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            if self.app is not None:
+                return self.app(environ, start_response)
+            return self.error(start_response, '404 Not Found')
+
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed',
+                           [('Content-Type', 'text/plain'),
+                            ('Allow', 'GET, HEAD')])
+            return ['405 Method Not Allowed\n']
+
+        filename = self.translate_path(path[len(self.prefix):])
+        st = filename and self.stat(filename)
+        if st and stat.S_ISDIR(st.st_mode):
+            filename = os.path.join(filename, self.index)
+            st = self.stat(filename)
+        if not st or not stat.S_ISREG(st.st_mode):
+            return self.error(start_response, '404 Not Found')
+
+        entry = self.lookup(filename, st)
+        if self.not_modified(environ, entry):
+            start_response('304 Not Modified', entry.headers[1:])
+            return []
+
+        if entry.data is not None:
+            headers = entry.headers + [('Content-Length', str(entry.size))]
+            start_response('200 OK', headers)
+            if method == 'HEAD':
+                return []
+            return [entry.data]
+
+        if method == 'HEAD':
+            headers = entry.headers + [('Content-Length', str(entry.size))]
+            start_response('200 OK', headers)
+            return []
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return self.error(start_response, '404 Not Found')
+        start_response('200 OK', entry.headers[:])
+        file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+        return file_wrapper(f, 65536)
+
+    def translate_path(self, path):
+        """Map a URL path below 'prefix' to a file name, or None
+
+        Paths that would leave 'root', or that the OS can't take, are
+        refused.
+        """
+        if '\0' in path:
+            return None
+        filename = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if filename != self.root and \
+                not filename.startswith(self.root + os.sep):
+            return None
+        return filename
+
+    def stat(self, filename):
+        try:
+            return os.stat(filename)
+        except OSError:
+            return None
+
+    def lookup(self, filename, st):
+        """Return the cache entry for 'filename', loading it if stale"""
+        with self.lock:
+            entry = self.cache.pop(filename, None)
+            if entry is not None:
+                if entry.is_current(st):
+                    self.cache[filename] = entry
+                    return entry
+                self.cache_size -= entry.size
+
+        if st.st_size > self.max_file_size:
+            return _Entry(filename, st)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return _Entry(filename, st)
+        entry = _Entry(filename, st, data)
+        # The file may have changed between stat() and read()
+        entry.size = len(data)
+
+        with self.lock:
+            old = self.cache.pop(filename, None)
+            if old is not None:
+                self.cache_size -= old.size
+            self.cache[filename] = entry
+            self.cache_size += entry.size
+            while self.cache_size > self.max_cache_size:
+                name, evicted = self.cache.popitem(last=False)
+                self.cache_size -= evicted.size
+        return entry
+
+    def not_modified(self, environ, entry):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            # Weak comparison: the tag may have been weakened on the way,
+            # by compression for instance
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            return '*' in tags or entry.etag in tags
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since.split(';')[0])
+            if since is not None:
+                return int(entry.mtime) <= mktime_tz(since)
+        return False
+
+    def error(self, start_response, status):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [status + '\n']
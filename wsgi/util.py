@@ -1,5 +1,11 @@
 from types import ListType, TupleType
+from collections import OrderedDict
+import os
+import re
 import time
+import socket
+import threading
+import Queue
 
 _hoppish = {
     'connection':1, 'keep-alive':1, 'proxy-authenticate':1,
@@ -22,15 +28,188 @@ def format_date_time(timestamp):
         _weekdayname[wd], day, _monthname[month], year, hh, mm, ss
     )
 
+_date_cache = (None, None)
+
+def cached_date_time():
+    """format_date_time() of the current time, formatted once per second"""
+    global _date_cache
+    now = int(time.time())
+    stamp, value = _date_cache
+    if stamp != now:
+        value = format_date_time(now)
+        _date_cache = (now, value)
+    return value
+
+
+class FileWrapper(object):
+    """Wrapper to convert file-like objects to iterables
+
+    Provided to applications as wsgi.file_wrapper; SimpleHandler
+    recognizes it and transmits regular files with sendfile().
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+def _libc_sendfile():
+    """Bind sendfile(2) through ctypes; Python 2 has no os.sendfile()"""
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        call = libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    call.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    call.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = call(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+# sendfile(out_fd, in_fd, offset, count) -> bytes sent, or None if missing
+sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+
+def parse_byte_range(value, size):
+    """Parse a Range header against an entity of 'size' bytes
+
+    Returns (start, stop) for a single byte range, with start >= size when
+    the range can't be satisfied, or None when the header should be
+    ignored (malformed, or several ranges).
+    """
+    unit, sep, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return size, size
+            return max(0, size - length), size
+        start = int(first)
+        stop = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if last and stop <= start:
+        return None
+    if start >= size:
+        return size, size
+    return start, min(stop, size)
+
+
+class HostnameCache(object):
+    """Reverse DNS lookups that never make the caller wait
+
+    lookup() answers from a cache bounded to 'maxsize' addresses whose
+    entries live 'ttl' seconds.  A miss returns None and queues the
+    address for a background thread; an expired entry is still returned
+    while it is being refreshed.
+    """
+
+    def __init__(self, ttl=300, maxsize=1024, resolve=socket.getfqdn):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.resolve = resolve
+        self.entries = OrderedDict()    # address -> (name, expires)
+        self.pending = set()
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def lookup(self, address):
+        entry = self.entries.get(address)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        self.schedule(address)
+        return entry and entry[0]
+
+    def schedule(self, address):
+        with self.lock:
+            if address in self.pending:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='hostname-resolver')
+                self.thread.daemon = True
+                self.thread.start()
+            try:
+                self.queue.put_nowait(address)
+            except Queue.Full:
+                return
+            self.pending.add(address)
+
+    def run(self):
+        while True:
+            address = self.queue.get()
+            try:
+                name = self.resolve(address)
+            except Exception:
+                name = address
+            with self.lock:
+                self.entries.pop(address, None)
+                self.entries[address] = (name, time.time() + self.ttl)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                self.pending.discard(address)
+
+
+# Characters that force a header parameter value to be quoted
+tspecials = re.compile(r'[ \(\)<>@,;:\\"/\[\]\?=]')
+
+def _formatparam(param, value=None, quote=1):
+    """Convenience function to format and return a key=value pair.
+
+    This will quote the value if needed or if quote is true.
+    """
+    if value is not None and len(value) > 0:
+        if quote or tspecials.search(value):
+            value = value.replace('\\', '\\\\').replace('"', r'\"')
+            return '%s="%s"' % (param, value)
+        else:
+            return '%s=%s' % (param, value)
+    else:
+        return param
+
 
 class Headers(object):
 
-    """Manage a collection of HTTP response headers"""
+    """Manage a collection of HTTP response headers
+
+    Besides the list of (name, value) tuples, an index maps lowercased
+    names to their values so lookups don't scan the list.  The list is
+    the one passed in and is updated in place; changing it directly
+    leaves the index out of date.
+    """
+
+    __slots__ = ('_headers', '_index')
 
     def __init__(self,headers):
         if type(headers) is not ListType:
             raise TypeError("Headers must be a list of name/value tuples")
         self._headers = headers
+        index = self._index = {}
+        for k, v in headers:
+            index.setdefault(k.lower(), []).append(v)
 
     def __len__(self):
         """Return the total number of headers, including duplicates."""
@@ -38,16 +217,24 @@ class Headers(object):
 
     def __setitem__(self, name, val):
         """Set the value of a header."""
-        del self[name]
+        lname = name.lower()
+        if lname in self._index:
+            self._remove(lname)
         self._headers.append((name, val))
+        self._index[lname] = [val]
 
     def __delitem__(self,name):
         """Delete all occurrences of a header, if present.
 
         Does *not* raise an exception if the header is missing.
         """
-        name = name.lower()
-        self._headers[:] = [kv for kv in self._headers if kv[0].lower() != name]
+        lname = name.lower()
+        if lname in self._index:
+            self._remove(lname)
+
+    def _remove(self, lname):
+        del self._index[lname]
+        self._headers[:] = [kv for kv in self._headers if kv[0].lower() != lname]
 
     def __getitem__(self,name):
         """Get the first header value for 'name'
@@ -62,7 +249,7 @@ class Headers(object):
 
     def has_key(self, name):
         """Return true if the message contains the header."""
-        return self.get(name) is not None
+        return name.lower() in self._index
 
     __contains__ = has_key
 
@@ -75,16 +262,14 @@ class Headers(object):
         fields deleted and re-inserted are always appended to the header list.
         If no fields exist with the given name, returns an empty list.
         """
-        name = name.lower()
-        return [kv[1] for kv in self._headers if kv[0].lower()==name]
+        return list(self._index.get(name.lower(), ()))
 
 
     def get(self,name,default=None):
         """Get the first header value for 'name', or return 'default'"""
-        name = name.lower()
-        for k,v in self._headers:
-            if k.lower()==name:
-                return v
+        values = self._index.get(name.lower())
+        if values:
+            return values[0]
         return default
 
 
@@ -124,7 +309,7 @@ class Headers(object):
     def __str__(self):
         """str() returns the formatted headers, complete with end line,
         suitable for direct HTTP transmission."""
-        return '\r\n'.join(["%s: %s" % kv for kv in self._headers]+['',''])
+        return ''.join([k + ': ' + v + '\r\n' for k, v in self._headers]) + '\r\n'
 
     def setdefault(self,name,value):
         """Return first matching header value for 'name', or 'value'
@@ -133,11 +318,15 @@ class Headers(object):
         and value 'value'."""
         result = self.get(name)
         if result is None:
-            self._headers.append((name,value))
+            self._append(name, value)
             return value
         else:
             return result
 
+    def _append(self, name, value):
+        self._headers.append((name, value))
+        self._index.setdefault(name.lower(), []).append(value)
+
     def add_header(self, _name, _value, **_params):
         """Extended header setting.
 
@@ -162,4 +351,4 @@ class Headers(object):
                 parts.append(k.replace('_', '-'))
             else:
                 parts.append(_formatparam(k.replace('_', '-'), v))
-        self._headers.append((_name, "; ".join(parts)))
+        self._append(_name, "; ".join(parts))